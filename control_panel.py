@@ -9,8 +9,12 @@ from tkinter.scrolledtext import ScrolledText
 from pathlib import Path
 import sys
 import shutil
+import argparse
+import time
+import queue
 import yaml
 import threading
+from collections import deque
 import pyautogui
 
 
@@ -24,10 +28,19 @@ def get_base_dir():
         return Path(__file__).parent
 
 
+def format_duration(seconds):
+    """剩余时间显示为 时:分:秒，超过一天时前面加天数"""
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    text = f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    return f"{days}天 {text}" if days else text
+
+
 class ControlPanel:
     """主控制面板"""
 
-    def __init__(self):
+    def __init__(self, profile=False):
         self.root = tk.Tk()
         self.root.title("库存批量修改自动化工具")
         self.root.geometry("900x700")
@@ -53,6 +66,16 @@ class ControlPanel:
         self.setup_ui()
         self.refresh_all()
 
+        # 机器人线程运行中，此时保存步骤会被热加载
+        self.bot_running = False
+
+        # --profile: 采样分析整个界面会话（含机器人线程），关闭窗口时写出结果
+        self.profiler = None
+        if profile:
+            from main_bot import SamplingProfiler
+            self.profiler = SamplingProfiler().start()
+            self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
     def load_config(self):
         """加载配置"""
         if self.config_path.exists():
@@ -73,7 +96,8 @@ class ControlPanel:
                 'confidence': 0.8,
                 'default_wait': 0.5,
                 'timeout': 10,
-                'failsafe': True
+                'failsafe': True,
+                'pacing': 'normal'
             },
             'steps': []
         }
@@ -82,8 +106,9 @@ class ControlPanel:
         """保存配置"""
         self.config['steps'] = self.steps
         try:
-            with open(str(self.config_path), 'w', encoding='utf-8') as f:
-                yaml.dump(self.config, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+            # 先写临时文件再替换，运行中的机器人会在两行之间自动加载新配置
+            from main_bot import write_config
+            write_config(self.config_path, self.config)
         except Exception as e:
             messagebox.showerror("保存失败", f"无法保存配置文件:\n{self.config_path}\n错误: {e}")
 
@@ -201,8 +226,19 @@ class ControlPanel:
         ttk.Button(toolbar, text="删除步骤", command=self.delete_step).pack(side='left', padx=5)
         ttk.Button(toolbar, text="上移", command=self.move_step_up).pack(side='left', padx=5)
         ttk.Button(toolbar, text="下移", command=self.move_step_down).pack(side='left', padx=5)
+        ttk.Button(toolbar, text="优化步骤", command=self.optimize_steps).pack(side='left', padx=5)
+        ttk.Button(toolbar, text="录制", command=self.record_macro).pack(side='left', padx=5)
         ttk.Button(toolbar, text="保存步骤", command=self.save_steps).pack(side='right', padx=5)
 
+        # 目标窗口：填写后获取的坐标相对窗口左上角，窗口移动后仍然有效
+        window_frame = ttk.Frame(self.tab_steps)
+        window_frame.pack(fill='x', padx=10)
+        ttk.Label(window_frame, text="目标窗口标题:").pack(side='left', padx=5)
+        window = self.config.get('settings', {}).get('window') or {}
+        self.window_title_var = tk.StringVar(value=window.get('title', ''))
+        ttk.Entry(window_frame, textvariable=self.window_title_var, width=30).pack(side='left', padx=5)
+        ttk.Label(window_frame, text="(包含即可，留空则使用屏幕坐标)", foreground='gray').pack(side='left')
+
         # 步骤列表
         list_frame = ttk.Frame(self.tab_steps)
         list_frame.pack(fill='both', expand=True, padx=10, pady=10)
@@ -231,7 +267,11 @@ class ControlPanel:
         for i, step in enumerate(self.steps, 1):
             # 显示坐标或文本/按键
             if 'x' in step and 'y' in step:
-                target = f"坐标({step['x']}, {step['y']})"
+                target = f"{'窗口' if step.get('relative') else ''}坐标({step['x']}, {step['y']})"
+            elif step.get('action') == 'verify':
+                target = f"区域{step.get('region', '')} -> {step.get('template', '')}"
+            elif 'when' in step:
+                target = "条件: " + yaml.dump(step['when'], allow_unicode=True, default_flow_style=True).strip()
             else:
                 target = step.get('text', step.get('key', ''))
             self.steps_tree.insert('', 'end', values=(i, step.get('name', ''), step.get('action', ''), target))
@@ -266,9 +306,145 @@ class ControlPanel:
             self.refresh_steps()
 
     def save_steps(self):
-        """保存步骤配置"""
+        """保存步骤配置，运行中的任务会在下一行开始前换上新步骤"""
+        from main_bot import validate_config
+        self.save_window_title()
+        if errors := validate_config({**self.config, 'steps': self.steps}):
+            messagebox.showerror("步骤有误", "请先修正以下问题:\n" + "\n".join(errors))
+            return
+        self.save_config()
+        messagebox.showinfo("成功", "步骤配置已保存!" + ("\n正在运行的任务会从下一行开始使用新步骤" if self.bot_running else ""))
+
+    def save_window_title(self):
+        """目标窗口标题写入 settings.window"""
+        settings = self.config.setdefault('settings', {})
+        if title := self.window_title_var.get().strip():
+            settings['window'] = {**(settings.get('window') or {}), 'title': title}
+        else:
+            settings.pop('window', None)
+
+    def window_anchor(self):
+        """按标题定位目标窗口，未填写或找不到时返回 None"""
+        if not (title := self.window_title_var.get().strip()):
+            return None
+        try:
+            from main_bot import WindowAnchor
+            return WindowAnchor(title).locate()
+        except Exception as e:
+            messagebox.showwarning("提示", f"找不到目标窗口，将使用屏幕坐标:\n{e}")
+            return None
+
+    def count_excel_rows(self):
+        """Excel 数据条数，读取失败时返回 0"""
+        excel_path = self.excel_path_var.get()
+        if not excel_path:
+            return 0
+        full_path = Path(excel_path)
+        if not full_path.is_absolute():
+            full_path = self.base_dir / excel_path
+        try:
+            import pandas as pd
+            return len(pd.read_excel(full_path, usecols=[0]))
+        except Exception:
+            return 0
+
+    def optimize_steps(self):
+        """分析步骤中的冗余操作，估算节省时间，可一键应用"""
+        from main_bot import optimize_steps
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("优化步骤")
+        dialog.geometry("700x450")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        rows_frame = ttk.Frame(dialog)
+        rows_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Label(rows_frame, text="数据条数:").pack(side='left')
+        rows_var = tk.StringVar(value=str(self.count_excel_rows() or 1))
+        ttk.Entry(rows_frame, textvariable=rows_var, width=8).pack(side='left', padx=5)
+        summary = ttk.Label(rows_frame, text="")
+        summary.pack(side='left', padx=10)
+
+        columns = ('步骤', '类型', '说明')
+        tree = ttk.Treeview(dialog, columns=columns, show='headings', height=12)
+        tree.heading('步骤', text='步骤')
+        tree.heading('类型', text='类型')
+        tree.heading('说明', text='说明')
+        tree.column('步骤', width=50)
+        tree.column('类型', width=80)
+        tree.column('说明', width=540)
+        tree.pack(fill='both', expand=True, padx=10)
+
+        pacing = self.config.get('settings', {}).get('pacing', 'normal')
+        result = {}
+
+        def analyse(*_):
+            try:
+                rows = max(1, int(rows_var.get()))
+            except ValueError:
+                rows = 1
+            optimized, findings, per_row, per_run = optimize_steps(self.steps, rows, pacing)
+            result['steps'] = optimized
+            tree.delete(*tree.get_children())
+            # 同一步的多条建议可能重叠（如删除整步已包含去掉清空），每步只计最大的一条
+            potential = {}
+            for f in findings:
+                message = f['message']
+                if f['kind'] == 'flag':
+                    message += f"（约 {f['saving']:.2f} 秒/行）"
+                    potential[f['step']] = max(potential.get(f['step'], 0), f['saving'])
+                tree.insert('', 'end', values=(f['step'], '已优化' if f['kind'] == 'merge' else '建议', message))
+            potential = sum(potential.values())
+            summary.config(text=f"已优化：每行节省 {per_row:.2f} 秒，{rows} 行共 {per_run / 60:.1f} 分钟\n"
+                                f"按建议修改最多还可每行节省 {potential:.2f} 秒，{rows} 行共 {potential * rows / 60:.1f} 分钟"
+                                if findings else "没有发现可优化的步骤")
+
+        rows_var.trace_add('write', analyse)
+        analyse()
+
+        def apply():
+            self.steps[:] = result['steps']
+            self.refresh_steps()
+            dialog.destroy()
+            messagebox.showinfo("完成", "已应用优化，请点击【保存步骤】保存")
+
+        ttk.Button(dialog, text="应用优化", command=apply).pack(pady=10)
+
+    def record_macro(self):
+        """录制一遍手动操作，生成步骤"""
+        if not messagebox.askokcancel("录制", "点击确定后窗口最小化，3秒后开始录制。\n"
+                                             "请用 Excel 第一行数据在目标软件中演示一遍，按 F12 结束。"):
+            return
+        self.save_window_title()
+        self.root.iconify()
+
+        def record():
+            try:
+                time.sleep(3)
+                from macro_recorder import record_steps
+                steps = record_steps(self.config)
+                self.root.after(0, lambda: self.apply_recorded_steps(steps))
+            except Exception as e:
+                message = str(e)
+                self.root.after(0, lambda: (self.root.deiconify(), messagebox.showerror("录制失败", message)))
+
+        threading.Thread(target=record, daemon=True).start()
+
+    def apply_recorded_steps(self, steps):
+        """把录制结果写入步骤配置"""
+        self.root.deiconify()
+        if not steps:
+            messagebox.showinfo("录制", "没有录到任何操作")
+            return
+        replace = messagebox.askyesnocancel("录制完成", f"录到 {len(steps)} 个步骤。\n"
+                                                     "是: 替换现有步骤\n否: 追加到现有步骤之后")
+        if replace is None:
+            return
+        self.steps[:] = steps if replace else self.steps + steps
+        self.refresh_steps()
         self.save_config()
-        messagebox.showinfo("成功", "步骤配置已保存!")
+        messagebox.showinfo("完成", "录制的步骤已保存，可以双击步骤微调")
 
     def add_step(self):
         """添加步骤"""
@@ -284,7 +460,7 @@ class ControlPanel:
         """打开步骤编辑对话框"""
         dialog = tk.Toplevel(self.root)
         dialog.title("编辑步骤" if edit_idx is not None else "添加步骤")
-        dialog.geometry("600x500")
+        dialog.geometry("650x780")
         dialog.transient(self.root)
         dialog.grab_set()
 
@@ -303,7 +479,12 @@ class ControlPanel:
             '输入文本': 'type_text',
             '按键': 'press_key',
             '等待秒数': 'wait',
-            '清空输入框': 'clear_input'
+            '清空输入框': 'clear_input',
+            '屏幕校验': 'verify',
+            '读取当前值(相同则跳过)': 'probe',
+            '条件分支': 'if',
+            '满足条件跳过本行': 'skip_row_if',
+            '重复直到满足条件': 'repeat_until'
         }
         action_display = {v: k for k, v in action_map.items()}
         action_list = list(action_map.keys())
@@ -330,6 +511,8 @@ class ControlPanel:
         y_var = tk.StringVar(value=str(step_data.get('y', '')))
         ttk.Entry(coord_frame, textvariable=y_var, width=6).pack(side='left', padx=2)
 
+        relative_var = tk.BooleanVar(value=step_data.get('relative', False))
+
         def get_mouse_pos():
             dialog.withdraw()
             self.root.withdraw()
@@ -337,6 +520,10 @@ class ControlPanel:
             import time
             time.sleep(3)
             x, y = pyautogui.position()
+            if anchor := self.window_anchor():
+                x, y = anchor.to_window(x, y)
+                anchor.close()
+            relative_var.set(anchor is not None)
             x_var.set(str(x))
             y_var.set(str(y))
 
@@ -351,17 +538,19 @@ class ControlPanel:
                     dialog.lift()
                     dialog.focus_force()
                     dialog.grab_set()
-                    messagebox.showinfo("完成", f"已获取坐标: ({x}, {y})\n请点击【保存】按钮保存此步骤")
+                    where = "窗口相对" if relative_var.get() else "屏幕"
+                    messagebox.showinfo("完成", f"已获取{where}坐标: ({x}, {y})\n请点击【保存】按钮保存此步骤")
                 dialog.after(100, focus_dialog)
             self.root.after(100, restore_windows)
 
         ttk.Button(coord_frame, text="获取鼠标位置", command=get_mouse_pos).pack(side='left', padx=10)
+        ttk.Checkbutton(coord_frame, text="相对窗口", variable=relative_var).pack(side='left')
 
         # 输入文本
         ttk.Label(dialog, text="输入内容:", font=('', 10)).grid(row=3, column=0, padx=10, pady=8, sticky='e')
         text_var = tk.StringVar(value=step_data.get('text', ''))
         ttk.Entry(dialog, textvariable=text_var, width=35).grid(row=3, column=1, padx=10, pady=8, sticky='w')
-        ttk.Label(dialog, text="提示: 用 {code} 代表编码, {quantity} 代表库存数", foreground='gray').grid(row=4, column=1, sticky='w', padx=10)
+        ttk.Label(dialog, text="提示: {code} 代表编码, {quantity} 代表库存数, {列名} 引用Excel任意列", foreground='gray').grid(row=4, column=1, sticky='w', padx=10)
 
         # 按键
         ttk.Label(dialog, text="按键:", font=('', 10)).grid(row=5, column=0, padx=10, pady=8, sticky='e')
@@ -404,6 +593,31 @@ class ControlPanel:
         clear_var = tk.BooleanVar(value=step_data.get('clear_first', False))
         ttk.Checkbutton(dialog, text="输入前先清空原内容", variable=clear_var).grid(row=8, column=1, padx=10, pady=8, sticky='w')
 
+        # 屏幕校验
+        ttk.Label(dialog, text="屏幕区域:", font=('', 10)).grid(row=9, column=0, padx=10, pady=8, sticky='e')
+        region = step_data.get('region')
+        region_var = tk.StringVar(value=','.join(str(v) for v in region) if region else '')
+        ttk.Entry(dialog, textvariable=region_var, width=35).grid(row=9, column=1, padx=10, pady=8, sticky='w')
+        ttk.Label(dialog, text="格式: x,y,宽,高 (屏幕校验的截取区域；等待步骤填写后改为等该区域画面稳定)",
+                  foreground='gray').grid(row=10, column=1, sticky='w', padx=10)
+
+        ttk.Label(dialog, text="模板图片:", font=('', 10)).grid(row=11, column=0, padx=10, pady=8, sticky='e')
+        template_var = tk.StringVar(value=step_data.get('template', ''))
+        ttk.Combobox(dialog, textvariable=template_var, width=32,
+                     values=sorted(p.name for p in self.assets_dir.glob('*.png'))).grid(row=11, column=1, padx=10, pady=8, sticky='w')
+
+        # 条件与子步骤 (条件分支 / 跳过本行 / 重复直到)
+        flow_keys = ('when', 'then', 'else', 'steps', 'max_times')
+        ttk.Label(dialog, text="条件与子步骤:", font=('', 10)).grid(row=12, column=0, padx=10, pady=8, sticky='ne')
+        flow_text = tk.Text(dialog, width=48, height=8, font=('Consolas', 9))
+        flow_text.grid(row=12, column=1, padx=10, pady=8, sticky='w')
+        flow_data = {k: step_data[k] for k in flow_keys if k in step_data}
+        if flow_data:
+            flow_text.insert('1.0', yaml.dump(flow_data, allow_unicode=True, default_flow_style=False, sort_keys=False))
+        ttk.Label(dialog, text="YAML格式, 例: when: {column: 库存数, op: '==', value: 0}\n"
+                               "屏幕探测: when: {region: [x,y,宽,高], template: 无结果.png}",
+                  foreground='gray').grid(row=13, column=1, sticky='w', padx=10)
+
         def save_step():
             action_text = action_combo.get()
             step = {
@@ -411,6 +625,24 @@ class ControlPanel:
                 'action': action_map.get(action_text, 'click')
             }
 
+            # 保留对话框中没有的字段（如 max_distance、retry）
+            managed = ('name', 'action', 'x', 'y', 'relative', 'text', 'key', 'clear_first', 'wait_after',
+                       'region', 'template') + flow_keys
+            step.update({k: v for k, v in step_data.items() if k not in managed})
+
+            # 条件与子步骤
+            try:
+                flow = yaml.safe_load(flow_text.get('1.0', 'end')) or {}
+                if not isinstance(flow, dict):
+                    raise ValueError("需要 YAML 字典")
+            except (yaml.YAMLError, ValueError) as e:
+                messagebox.showerror("格式错误", f"条件与子步骤解析失败:\n{e}", parent=dialog)
+                return
+            if step['action'] in ('if', 'skip_row_if', 'repeat_until') and 'when' not in flow:
+                messagebox.showerror("格式错误", "该动作需要填写 when 条件", parent=dialog)
+                return
+            step.update({k: v for k, v in flow.items() if k in flow_keys})
+
             # 坐标
             if x_var.get() and y_var.get():
                 try:
@@ -431,6 +663,19 @@ class ControlPanel:
             if clear_var.get():
                 step['clear_first'] = True
 
+            # 校验区域和模板
+            if region_var.get():
+                try:
+                    region = [int(v) for v in region_var.get().replace('，', ',').split(',')]
+                    if len(region) == 4:
+                        step['region'] = region
+                except ValueError:
+                    pass
+            if template_var.get():
+                step['template'] = template_var.get()
+            if relative_var.get() and ('x' in step or 'region' in step):
+                step['relative'] = True
+
             # 等待时间
             try:
                 wait = float(wait_var.get())
@@ -447,7 +692,7 @@ class ControlPanel:
             self.refresh_steps()
             dialog.destroy()
 
-        ttk.Button(dialog, text="保存", command=save_step).grid(row=9, column=1, pady=20)
+        ttk.Button(dialog, text="保存", command=save_step).grid(row=14, column=1, pady=20)
 
     # ==================== 运行标签页 ====================
     def setup_run_tab(self):
@@ -475,6 +720,31 @@ class ControlPanel:
         ttk.Entry(limit_frame, textvariable=self.limit_var, width=8).pack(side='left', padx=5)
         ttk.Label(limit_frame, text="(0 = 按Excel数据条数)", foreground='gray').pack(side='left')
 
+        ttk.Label(limit_frame, text="操作节奏:", font=('', 10)).pack(side='left', padx=(20, 0))
+        self.pacing_var = tk.StringVar(value=self.config.get('settings', {}).get('pacing', 'normal'))
+        ttk.Combobox(limit_frame, textvariable=self.pacing_var, values=['safe', 'normal', 'turbo'],
+                     width=8, state='readonly').pack(side='left', padx=5)
+        ttk.Label(limit_frame, text="(目标软件反应慢时用 safe)", foreground='gray').pack(side='left')
+
+        # 时间预算
+        budget_frame = ttk.Frame(self.tab_run)
+        budget_frame.pack(pady=(0, 10))
+        ttk.Label(budget_frame, text="时间预算(分钟):", font=('', 10)).pack(side='left')
+        schedule = self.config.get('settings', {}).get('schedule') or {}
+        self.budget_var = tk.StringVar(value=str(schedule.get('budget', 0)))
+        ttk.Entry(budget_frame, textvariable=self.budget_var, width=8).pack(side='left', padx=5)
+        ttk.Label(budget_frame, text="(0 = 不限；到时前停下，剩余的行下次运行继续)", foreground='gray').pack(side='left')
+
+        # 性能分析
+        profile_frame = ttk.Frame(self.tab_run)
+        profile_frame.pack()
+        self.profile_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(profile_frame, text="性能分析", variable=self.profile_var).pack(side='left')
+        ttk.Label(profile_frame, text="只分析第").pack(side='left', padx=(10, 0))
+        self.profile_rows_var = tk.StringVar(value="")
+        ttk.Entry(profile_frame, textvariable=self.profile_rows_var, width=10).pack(side='left', padx=5)
+        ttk.Label(profile_frame, text="行 (如 500-550，留空 = 整次运行，结果在 logs/)", foreground='gray').pack(side='left')
+
         # 运行按钮
         btn_frame = ttk.Frame(self.tab_run)
         btn_frame.pack(pady=20)
@@ -483,6 +753,27 @@ class ControlPanel:
         self.run_btn.pack(side='left', padx=10)
 
         ttk.Button(btn_frame, text="刷新检查", command=self.check_ready).pack(side='left', padx=10)
+        ttk.Button(btn_frame, text="历史对比", command=self.show_history).pack(side='left', padx=10)
+
+        # 进度面板
+        progress_frame = ttk.LabelFrame(self.tab_run, text="运行进度", padding=10)
+        progress_frame.pack(fill='x', padx=20, pady=5)
+
+        self.progress_bar = ttk.Progressbar(progress_frame, mode='determinate', maximum=1)
+        self.progress_bar.pack(fill='x')
+
+        stat_frame = ttk.Frame(progress_frame)
+        stat_frame.pack(fill='x', pady=(8, 0))
+        self.progress_labels = {}
+        for i, (key, text) in enumerate([('done', '进度'), ('rate', '速度'), ('eta', '预计剩余'),
+                                         ('success', '成功'), ('failed', '失败'), ('skipped', '跳过')]):
+            ttk.Label(stat_frame, text=f"{text}:").grid(row=i // 3, column=(i % 3) * 2, sticky='e', padx=(10, 2))
+            self.progress_labels[key] = ttk.Label(stat_frame, text="-", width=14)
+            self.progress_labels[key].grid(row=i // 3, column=(i % 3) * 2 + 1, sticky='w')
+
+        # 进度通道：机器人线程只往队列里放快照，界面每 500ms 取一次
+        self.progress_queue = queue.Queue(maxsize=1000)
+        self.progress_window = deque(maxlen=20)
 
         # 日志区域
         log_frame = ttk.LabelFrame(self.tab_run, text="运行日志", padding=10)
@@ -520,6 +811,56 @@ class ControlPanel:
 
         return all_ok
 
+    def poll_progress(self):
+        """按固定频率读取进度快照并刷新进度面板"""
+        latest = None
+        finished = False
+        while True:
+            try:
+                event = self.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event['event'] == 'start':
+                self.progress_window.clear()
+            elif event['event'] in ('end', 'stopped'):
+                finished = True
+            if 'total' in event:
+                latest = event
+            if event['event'] == 'row':
+                self.progress_window.append((event['time'], event['done']))
+
+        if latest:
+            done = latest.get('done', 0)
+            total = latest['total'] or 1
+            self.progress_bar.config(maximum=total, value=done)
+            self.progress_labels['done'].config(text=f"{done}/{latest['total']}")
+            for key in ('success', 'failed', 'skipped'):
+                self.progress_labels[key].config(text=str(latest[key]))
+
+            # 滑动窗口平均速度，窗口内只有一行时用不了
+            if len(self.progress_window) >= 2:
+                (t0, d0), (t1, d1) = self.progress_window[0], self.progress_window[-1]
+                if t1 > t0:
+                    rate = (d1 - d0) / (t1 - t0)
+                    self.progress_labels['rate'].config(text=f"{rate * 60:.1f} 行/分")
+                    remaining = (total - done) / rate if rate > 0 else 0
+                    self.progress_labels['eta'].config(text=format_duration(remaining))
+
+        if finished:
+            self.progress_labels['eta'].config(text="已结束")
+        else:
+            self.root.after(500, self.poll_progress)
+
+    def show_history(self):
+        """对比最近两个配置版本的吞吐和失败率，写入运行日志"""
+        from main_bot import RunHistory
+        history = RunHistory()
+        self.log("=" * 40)
+        self.log("最近两个配置版本对比:")
+        for line in history.compare():
+            self.log(line)
+        history.close()
+
     def log(self, msg):
         """写入日志"""
         self.log_text.insert(tk.END, msg + '\n')
@@ -538,12 +879,41 @@ class ControlPanel:
         except ValueError:
             limit = 0
 
+        # 时间预算
+        from main_bot import parse_budget
+        try:
+            budget = parse_budget(self.budget_var.get().strip())
+        except ValueError:
+            messagebox.showwarning("提示", "时间预算需要是非负的数字（分钟）")
+            return
+
+        # 性能分析范围
+        profile = None
+        if self.profile_var.get():
+            from main_bot import parse_row_range
+            try:
+                profile = parse_row_range(self.profile_rows_var.get()) or True
+            except ValueError as e:
+                messagebox.showwarning("提示", str(e))
+                return
+
         # 保存配置
+        settings = self.config.setdefault('settings', {})
+        settings['pacing'] = self.pacing_var.get()
+        if budget or settings.get('schedule'):
+            settings['schedule'] = {**(settings.get('schedule') or {}), 'budget': budget}
+        self.save_window_title()
+        from main_bot import validate_config
+        if errors := validate_config(self.config):
+            messagebox.showerror("配置有误", "请先修正以下问题:\n" + "\n".join(errors))
+            return
         self.save_config()
 
         self.log("=" * 40)
         self.log("准备启动自动化...")
         self.log(f"执行条数: {'全部' if limit == 0 else limit}")
+        if budget:
+            self.log(f"时间预算: {budget:g} 分钟")
         self.log("窗口将自动最小化，完成后恢复")
         self.log("安全提示: 将鼠标移到屏幕左上角可紧急停止")
         self.log("=" * 40)
@@ -566,18 +936,32 @@ class ControlPanel:
                 from main_bot import AutomationBot
 
                 self.log("正在创建自动化实例...")
-                bot = AutomationBot(str(self.config_path))
+                bot = AutomationBot(str(self.config_path), progress=self.progress_queue)
 
                 self.log("开始执行自动化...")
-                bot.run(limit=limit)
+                bot.run(limit=limit, profile=profile, budget=budget)
                 self.log("运行完成!")
+                if bot.leftover:
+                    self.log(f"时间预算用完，剩余 {len(bot.leftover)} 行下次运行继续")
+                self.show_history()
             except Exception as e:
                 self.log(f"错误: {e}")
                 self.log(f"详细信息:\n{traceback.format_exc()}")
             finally:
+                self.bot_running = False
+                self.progress_queue.put({'event': 'stopped'})
                 # 恢复窗口
                 self.root.after(0, self.root.deiconify)
 
+        # 清掉上一次运行残留的事件
+        while not self.progress_queue.empty():
+            self.progress_queue.get_nowait()
+        for label in self.progress_labels.values():
+            label.config(text="-")
+        self.progress_bar.config(value=0)
+        self.root.after(500, self.poll_progress)
+
+        self.bot_running = True
         threading.Thread(target=run_bot, daemon=True).start()
 
     def refresh_all(self):
@@ -592,11 +976,21 @@ class ControlPanel:
             if full_path.exists():
                 self.preview_excel(full_path)
 
+    def on_close(self):
+        """关闭窗口时写出界面会话的性能分析结果"""
+        from main_bot import profile_output_base
+        self.profiler.stop()
+        self.profiler.write(profile_output_base('profile_panel'))
+        self.root.destroy()
+
     def run(self):
         """运行主循环"""
         self.root.mainloop()
 
 
 if __name__ == "__main__":
-    app = ControlPanel()
+    parser = argparse.ArgumentParser(description="库存自动化控制面板")
+    parser.add_argument('--profile', action='store_true', help="采样分析整个界面会话，关闭窗口时写到 logs/")
+    args = parser.parse_args()
+    app = ControlPanel(profile=args.profile)
     app.run()
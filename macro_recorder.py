@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+宏录制 - 手动演示一遍操作，自动生成精简的步骤列表
+运行: python macro_recorder.py [--config config.yaml] [--stop-key f12]
+
+录制期间记录鼠标点击、按键、粘贴，同时在后台持续截屏计算感知哈希，
+用每次操作后画面最后一次变化的时间作为该步的等待时间。
+输入的文本与 Excel 第一行数据比对，自动替换成 {code} / {quantity} / {列名}。
+"""
+
+import math
+import time
+import argparse
+import threading
+from pathlib import Path
+
+import yaml
+import pyautogui
+import pyperclip
+
+from main_bot import (BASE_DIR, ScreenCapture, WindowAnchor, format_value, hash_distance,
+                      region_hash, write_config, get_logger)
+
+MODIFIERS = {'ctrl', 'ctrl_l', 'ctrl_r', 'alt', 'alt_l', 'alt_r', 'alt_gr', 'shift', 'shift_l', 'shift_r',
+             'cmd', 'cmd_l', 'cmd_r'}
+# pynput 按键名 -> pyautogui 按键名
+KEY_NAMES = {'esc': 'escape', 'page_up': 'pageup', 'page_down': 'pagedown', 'caps_lock': 'capslock',
+             'print_screen': 'printscreen', 'num_lock': 'numlock', 'scroll_lock': 'scrolllock'}
+DOUBLE_CLICK_SECONDS = 0.4
+
+
+class MacroRecorder:
+    """录制一次手动演示：输入事件 + 屏幕哈希时间线"""
+
+    def __init__(self, region=None, stop_key='f12', interval=0.05):
+        try:
+            from pynput import keyboard, mouse
+        except ImportError:
+            raise RuntimeError("录制需要 pynput: pip install pynput")
+        self.keyboard, self.mouse = keyboard, mouse
+        width, height = pyautogui.size()
+        self.region = region or [0, 0, width, height]
+        self.stop_key = stop_key
+        self.interval = interval
+        self.events = []    # [(时间, 类型, 内容)]
+        self.samples = []   # [(时间, 哈希)]
+        self.modifiers = set()
+        self.stopped = threading.Event()
+
+    def _key_name(self, key):
+        if isinstance(key, self.keyboard.Key):
+            name = key.name
+            for mod in ('ctrl', 'alt', 'shift', 'cmd'):
+                if name.startswith(mod):
+                    return mod if name in MODIFIERS else name
+            return KEY_NAMES.get(name, name)
+        if key.char is None:
+            return None
+        # Windows 下按住 Ctrl 时 char 是控制字符
+        return chr(ord(key.char) + 96) if ord(key.char) < 32 else key.char
+
+    def on_press(self, key):
+        now = time.monotonic()
+        name = self._key_name(key)
+        if name is None:
+            return
+        if name == self.stop_key:
+            self.stopped.set()
+            return False
+        if name in ('ctrl', 'alt', 'shift', 'cmd'):
+            self.modifiers.add(name)
+            return
+        special = isinstance(key, self.keyboard.Key)
+        # Shift 加字符已经体现在字符本身，只有 Shift 加功能键（如 shift+tab）才算组合键
+        held = [m for m in ('ctrl', 'alt', 'shift', 'cmd') if m in self.modifiers and (special or m != 'shift')]
+        if held:
+            combo = '+'.join(held + [name.lower()])
+            if combo == 'ctrl+v':
+                self.events.append((now, 'paste', pyperclip.paste()))
+            else:
+                self.events.append((now, 'hotkey', combo))
+        elif not special:
+            self.events.append((now, 'char', name))
+        elif name == 'space':
+            self.events.append((now, 'char', ' '))
+        else:
+            self.events.append((now, 'key', name))
+
+    def on_release(self, key):
+        if (name := self._key_name(key)) in self.modifiers:
+            self.modifiers.discard(name)
+
+    def on_click(self, x, y, button, pressed):
+        if not pressed:
+            return
+        if button != self.mouse.Button.left:
+            get_logger().warning(f"只录制左键点击，忽略 {button.name} 键 ({x}, {y})")
+            return
+        self.events.append((time.monotonic(), 'click', (int(x), int(y))))
+
+    def _sample(self):
+        """后台截屏，记录画面哈希的时间线（隔 4 像素取样，16x16 哈希对小变化更敏感）"""
+        capture = ScreenCapture()
+        try:
+            while not self.stopped.is_set():
+                self.samples.append((time.monotonic(), region_hash(capture.grab_gray(self.region)[::4, ::4], size=16)))
+                time.sleep(self.interval)
+        finally:
+            capture.close()
+
+    def record(self):
+        """录制直到按下结束键，返回 (事件, 哈希时间线)"""
+        sampler = threading.Thread(target=self._sample, name='recorder-sampler', daemon=True)
+        sampler.start()
+        with self.mouse.Listener(on_click=self.on_click) as mouse_listener, \
+                self.keyboard.Listener(on_press=self.on_press, on_release=self.on_release) as key_listener:
+            key_listener.join()
+            mouse_listener.stop()
+        self.stopped.set()
+        sampler.join()
+        return self.events, self.samples
+
+
+def settle_time(samples, start, end, threshold=2):
+    """start 之后到 end 之前画面最后一次变化距 start 的秒数，没有变化时为 0"""
+    window = [(t, h) for t, h in samples if start < t < end]
+    before = [h for t, h in samples if t <= start]
+    last_change = None
+    previous = before[-1] if before else (window[0][1] if window else None)
+    for t, h in window:
+        if hash_distance(h, previous) > threshold:
+            last_change = t
+            previous = h
+    return last_change - start if last_change is not None else 0.0
+
+
+def measured_wait(seconds, interval=0.05, margin=1.2, step=0.05):
+    """实测稳定时间留出余量，按 step 向上取整；画面没有变化时不需要额外等待"""
+    if seconds <= 0:
+        return 0
+    return round(math.ceil((seconds + interval) * margin / step) * step, 2)
+
+
+def infer_placeholders(text, sample, aliases):
+    """把演示时输入的 Excel 第一行的值替换成占位符"""
+    if not sample:
+        return text
+    names = {column: alias for alias, column in aliases.items()}
+    candidates = sorted(((format_value(value), '{' + names.get(column, column) + '}')
+                         for column, value in sample.items() if format_value(value)),
+                        key=lambda c: -len(c[0]))
+    for value, placeholder in candidates:
+        if text == value:
+            return placeholder
+    # 部分匹配只替换足够长的值，避免把单个数字误当成库存数
+    for value, placeholder in candidates:
+        if len(value) >= 3 and value in text:
+            text = text.replace(value, placeholder)
+    return text
+
+
+def compress_events(events, samples, sample=None, aliases=None, anchor=None, interval=0.05):
+    """把原始事件压缩为步骤列表
+
+    连续按下的字符合并为一次输入，退格在输入内容里直接删除；Ctrl+A 紧接输入时并入
+    「输入前先清空」；两次相近的点击合并为双击；每步的等待时间取画面实测稳定时间。
+    """
+    actions = []
+    for t, kind, payload in events:
+        last = actions[-1] if actions else None
+        if kind in ('char', 'paste') and last and last['kind'] == 'type':
+            last['text'] += payload
+            last['time'] = t
+        elif kind in ('char', 'paste'):
+            actions.append({'kind': 'type', 'text': payload, 'time': t,
+                            'clear': bool(last and last['kind'] == 'hotkey' and last['key'] == 'ctrl+a')})
+            if actions[-1]['clear']:
+                actions.pop(-2)
+        elif kind == 'key' and payload == 'backspace' and last and last['kind'] == 'type' and last['text']:
+            last['text'] = last['text'][:-1]
+            last['time'] = t
+        elif kind == 'click' and last and last['kind'] == 'click' and last['pos'] == payload \
+                and t - last['time'] <= DOUBLE_CLICK_SECONDS and not last['double']:
+            last['double'] = True
+            last['time'] = t
+        elif kind == 'click':
+            actions.append({'kind': 'click', 'pos': payload, 'time': t, 'double': False})
+        else:
+            actions.append({'kind': 'hotkey' if kind == 'hotkey' else 'key', 'key': payload, 'time': t})
+
+    aliases = aliases or {}
+    steps = []
+    for i, action in enumerate(actions):
+        if action['kind'] == 'click':
+            x, y = action['pos']
+            step = {'name': f"{'双击' if action['double'] else '点击'}({x}, {y})",
+                    'action': 'double_click' if action['double'] else 'click'}
+            if anchor is not None:
+                x, y = anchor.to_window(x, y)
+                step.update(x=x, y=y, relative=True)
+            else:
+                step.update(x=x, y=y)
+        elif action['kind'] == 'type':
+            text = infer_placeholders(action['text'], sample, aliases)
+            step = {'name': f"输入 {text}", 'action': 'type_text', 'text': text}
+            if action['clear']:
+                step['clear_first'] = True
+        else:
+            step = {'name': f"按键 {action['key']}", 'action': 'press_key', 'key': action['key']}
+        end = actions[i + 1]['time'] if i + 1 < len(actions) else float('inf')
+        if wait := measured_wait(settle_time(samples, action['time'], end), interval):
+            step['wait_after'] = wait
+        steps.append(step)
+    return steps
+
+
+def first_row(config):
+    """Excel 第一行数据，用于推断占位符；读不到时返回 None"""
+    excel_cfg = config.get('excel') or {}
+    if not excel_cfg.get('file_path'):
+        return None
+    path = Path(excel_cfg['file_path'])
+    if not path.is_absolute():
+        path = BASE_DIR / path
+    try:
+        import pandas as pd
+        df = pd.read_excel(path, sheet_name=excel_cfg.get('sheet_name') or 0, nrows=1)
+    except Exception as e:
+        get_logger().warning(f"读取 Excel 第一行失败，不推断占位符: {e}")
+        return None
+    return df.iloc[0].to_dict() if len(df) else None
+
+
+def record_steps(config, stop_key='f12'):
+    """按配置录制一次演示，返回生成的步骤列表
+
+    配置了目标窗口时只截取窗口区域，坐标记录为窗口相对坐标。
+    """
+    window = (config.get('settings') or {}).get('window') or {}
+    anchor = WindowAnchor(window['title']).locate() if window.get('title') else None
+    region = list(anchor.geometry) if anchor else None
+    try:
+        recorder = MacroRecorder(region=region, stop_key=stop_key)
+        events, samples = recorder.record()
+    finally:
+        if anchor:
+            anchor.close()
+    excel_cfg = config.get('excel') or {}
+    aliases = {'code': excel_cfg.get('code_column'), 'quantity': excel_cfg.get('quantity_column')}
+    steps = compress_events(events, samples, first_row(config), aliases, anchor, recorder.interval)
+    get_logger().info(f"录制结束: {len(events)} 个输入事件 -> {len(steps)} 个步骤")
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="录制一遍手动操作，生成步骤")
+    parser.add_argument('--config', default='config.yaml', help="配置文件")
+    parser.add_argument('--stop-key', default='f12', help="结束录制的按键")
+    parser.add_argument('--append', action='store_true', help="追加到现有步骤之后（默认替换）")
+    parser.add_argument('--countdown', type=int, default=3, help="开始前倒计时秒数")
+    args = parser.parse_args()
+
+    config_path = Path(args.config)
+    if not config_path.is_absolute():
+        config_path = BASE_DIR / config_path
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f) or {}
+
+    print(f"{args.countdown} 秒后开始录制，请切换到目标软件，用 Excel 第一行数据演示一遍，按 {args.stop_key.upper()} 结束")
+    time.sleep(args.countdown)
+    steps = record_steps(config, args.stop_key)
+    print(yaml.dump(steps, allow_unicode=True, default_flow_style=False, sort_keys=False))
+    config['steps'] = (config.get('steps') or []) + steps if args.append else steps
+    write_config(config_path, config)
+    print(f"已写入 {config_path} ({len(steps)} 个步骤)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,48 @@
 使用方法: python main_bot.py
 """
 
+import io
 import os
+import re
 import sys
+import math
+import json
+import uuid
+import sqlite3
+import difflib
+import gzip
+import shutil
+import hashlib
+import argparse
+import platform
 import time
+import queue
+import asyncio
 import logging
+import logging.handlers
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
 from datetime import datetime
 from pathlib import Path
 
 import yaml
+import numpy as np
 import pandas as pd
 import pyautogui
 import pyperclip
+from PIL import Image
+
+try:
+    import mss
+except ImportError:  # 未安装 mss 时退回 pyautogui 截图
+    mss = None
 
 # 设置 PyAutoGUI 安全模式
+# 不使用全局 PAUSE（每次调用后固定停 0.1 秒），操作间隔由 Pacer 按动作类型控制
 pyautogui.FAILSAFE = True
-pyautogui.PAUSE = 0.1
+pyautogui.PAUSE = 0
 
 
 def get_base_dir():
@@ -32,8 +59,1303 @@ def get_base_dir():
 BASE_DIR = get_base_dir()
 
 
+def region_hash(img, size=8):
+    """计算感知哈希 (dHash)，只做块平均缩放，不做整图比对"""
+    if img.ndim == 3:
+        img = img[..., :3].mean(axis=2)
+    img = np.asarray(img, dtype=np.float32)
+    h, w = img.shape
+    if h < size or w < size + 1:
+        raise ValueError(f"校验区域过小: {w}x{h}")
+    # 按块求平均，把区域缩放到 size x (size+1)
+    ys = np.linspace(0, h, size + 1).astype(int)
+    xs = np.linspace(0, w, size + 2).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(img, ys[:-1], axis=0), xs[:-1], axis=1)
+    small = sums / np.outer(np.diff(ys), np.diff(xs))
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hash_distance(a, b):
+    """两个哈希的汉明距离"""
+    return bin(a ^ b).count('1')
+
+
+PLACEHOLDER_RE = re.compile(r'\{([^{}]+)\}')
+
+
+def format_value(value):
+    """单元格值转文本：空值为空串，整数形式的浮点数去掉 .0"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+COMPARE_OPS = ('==', '!=', '>', '>=', '<', '<=', 'contains', 'empty', 'not_empty')
+
+
+def compare_values(left, op, right):
+    """条件比较：两边都能转成数字时按数值比较，否则按文本比较"""
+    if op == 'empty':
+        return format_value(left) == ''
+    if op == 'not_empty':
+        return format_value(left) != ''
+    if op == 'contains':
+        return format_value(right) in format_value(left)
+    try:
+        left, right = float(left), float(right)
+    except (TypeError, ValueError):
+        left, right = format_value(left), format_value(right)
+    if op == '==':
+        return left == right
+    if op == '!=':
+        return left != right
+    if op == '>':
+        return left > right
+    if op == '>=':
+        return left >= right
+    if op == '<':
+        return left < right
+    if op == '<=':
+        return left <= right
+    raise ValueError(f"未知比较符: {op}")
+
+
+class TextTemplate:
+    """文本模板 - 运行开始时解析一次，之后每行只做拼接
+
+    占位符写作 {列名}，{code} 和 {quantity} 是编码列、库存列的别名。
+    """
+
+    def __init__(self, text, aliases=None):
+        aliases = aliases or {}
+        self.text = text
+        self.parts = []
+        pos = 0
+        for m in PLACEHOLDER_RE.finditer(text):
+            name = m.group(1).strip()
+            self.parts.append((text[pos:m.start()], aliases.get(name, name)))
+            pos = m.end()
+        self.tail = text[pos:]
+        self.columns = [col for _, col in self.parts]
+
+    def render(self, data):
+        """用一行数据渲染文本"""
+        out = [lit + format_value(data.get(col)) for lit, col in self.parts]
+        out.append(self.tail)
+        return ''.join(out)
+
+
+# 各动作与上一次输入之间的最小间隔（秒）
+PACING_PROFILES = {
+    'safe': {'click': 0.15, 'press': 0.1, 'hotkey': 0.15, 'select': 0.1, 'paste': 0.15},
+    'normal': {'click': 0.05, 'press': 0.03, 'hotkey': 0.05, 'select': 0.03, 'paste': 0.08},
+    'turbo': {'click': 0.01, 'press': 0.01, 'hotkey': 0.01, 'select': 0.01, 'paste': 0.03},
+}
+
+
+class Pacer:
+    """操作节奏控制 - 保证每类动作与上一次输入之间至少间隔指定时间
+
+    与全局 PAUSE 不同，步骤的 wait_after 也算在间隔里，等待过后不再额外停顿。
+    同时统计节奏控制实际花掉的时间，用于运行结束时的报告。
+    """
+
+    def __init__(self, profile='normal', overrides=None):
+        if profile not in PACING_PROFILES:
+            raise ValueError(f"未知节奏方案: {profile}，可选: {', '.join(PACING_PROFILES)}")
+        self.profile = profile
+        self.delays = {**PACING_PROFILES[profile], **(overrides or {})}
+        self.last_event = 0.0
+        self.cost = {kind: 0.0 for kind in self.delays}
+        self.counts = {kind: 0 for kind in self.delays}
+
+    def wait(self, kind, before_sleep=None):
+        """在发出 kind 类动作前补足最小间隔，需要等待时先调用 before_sleep"""
+        gap = self.delays.get(kind, 0) - (time.monotonic() - self.last_event)
+        if gap > 0:
+            if before_sleep:
+                before_sleep()
+            time.sleep(gap)
+            self.cost[kind] = self.cost.get(kind, 0.0) + gap
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def configure(self, profile, overrides=None):
+        """运行中切换节奏方案，已统计的耗时保留"""
+        if profile not in PACING_PROFILES:
+            raise ValueError(f"未知节奏方案: {profile}，可选: {', '.join(PACING_PROFILES)}")
+        self.profile = profile
+        self.delays = {**PACING_PROFILES[profile], **(overrides or {})}
+        for kind in self.delays:
+            self.cost.setdefault(kind, 0.0)
+            self.counts.setdefault(kind, 0)
+
+    def mark(self):
+        """记录一次输入事件结束的时间"""
+        self.last_event = time.monotonic()
+
+    def report(self):
+        """节奏控制耗时报告: {动作类型: (次数, 秒)}"""
+        return {kind: (self.counts[kind], self.cost[kind]) for kind in self.cost if self.counts.get(kind)}
+
+
+class PyAutoGUIBackend:
+    """输入后端 - pyautogui，中文通过剪贴板粘贴"""
+
+    def click(self, x, y):
+        pyautogui.click(x, y)
+
+    def double_click(self, x, y):
+        pyautogui.doubleClick(x, y)
+
+    def hotkey(self, *keys):
+        pyautogui.hotkey(*keys)
+
+    def press(self, key):
+        pyautogui.press(key)
+
+    def type_text(self, text):
+        pyperclip.copy(text)
+        pyautogui.hotkey('ctrl', 'v')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class X11Windows:
+    """X11 下按标题查找窗口、读取窗口位置"""
+
+    def __init__(self):
+        try:
+            from Xlib import X, display, error
+        except ImportError:
+            raise RuntimeError("窗口定位需要 python-xlib: pip install python-xlib")
+        self.X, self.error = X, error
+        self.display = display.Display()
+        self.root = self.display.screen().root
+
+    def _title(self, win):
+        name = win.get_full_text_property(self.display.intern_atom('_NET_WM_NAME'))
+        return name or win.get_wm_name() or ''
+
+    def find(self, title):
+        """按标题（包含即可）查找窗口，优先用窗口管理器的客户端列表"""
+        clients = self.root.get_full_property(self.display.intern_atom('_NET_CLIENT_LIST'), self.X.AnyPropertyType)
+        if clients:
+            candidates = [self.display.create_resource_object('window', wid) for wid in clients.value]
+        else:
+            candidates, todo = [], [self.root]
+            while todo:
+                children = todo.pop().query_tree().children
+                candidates += children
+                todo += children
+        for win in candidates:
+            try:
+                if title in self._title(win):
+                    return win
+            except self.error.XError:
+                continue
+        return None
+
+    def geometry(self, win):
+        """窗口内容区域的屏幕坐标 (x, y, 宽, 高)，窗口已关闭时返回 None"""
+        try:
+            origin = self.root.translate_coords(win, 0, 0)
+            geom = win.get_geometry()
+        except self.error.XError:
+            return None
+        return origin.x, origin.y, geom.width, geom.height
+
+    def close(self):
+        self.display.close()
+
+
+class Win32Windows:
+    """Windows 下按标题查找窗口、读取窗口位置"""
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+        self.ctypes, self.wintypes = ctypes, wintypes
+        self.user32 = ctypes.windll.user32
+
+    def find(self, title):
+        """按标题（包含即可）查找可见窗口"""
+        ctypes, user32 = self.ctypes, self.user32
+        found = []
+
+        def callback(hwnd, _):
+            if user32.IsWindowVisible(hwnd):
+                length = user32.GetWindowTextLengthW(hwnd)
+                buf = ctypes.create_unicode_buffer(length + 1)
+                user32.GetWindowTextW(hwnd, buf, length + 1)
+                if title in buf.value:
+                    found.append(hwnd)
+                    return False
+            return True
+
+        proc = ctypes.WINFUNCTYPE(ctypes.c_bool, self.wintypes.HWND, self.wintypes.LPARAM)(callback)
+        user32.EnumWindows(proc, 0)
+        return found[0] if found else None
+
+    def geometry(self, hwnd):
+        """窗口内容区域的屏幕坐标 (x, y, 宽, 高)，窗口已关闭时返回 None"""
+        if not self.user32.IsWindow(hwnd):
+            return None
+        point = self.wintypes.POINT(0, 0)
+        rect = self.wintypes.RECT()
+        self.user32.ClientToScreen(hwnd, self.ctypes.byref(point))
+        self.user32.GetClientRect(hwnd, self.ctypes.byref(rect))
+        return point.x, point.y, rect.right, rect.bottom
+
+    def close(self):
+        pass
+
+
+class WindowAnchor:
+    """窗口锚点 - 启动时按标题找一次目标窗口并缓存位置，相对坐标据此换算
+
+    每行开始前只读一次缓存窗口的位置（一次系统调用），发现移动才更新；
+    窗口句柄失效时才重新按标题查找。
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.windows = Win32Windows() if sys.platform == 'win32' else X11Windows()
+        self.handle = None
+        self.geometry = None
+
+    def locate(self):
+        """按标题查找窗口并缓存位置"""
+        self.handle = self.windows.find(self.title)
+        self.geometry = self.windows.geometry(self.handle) if self.handle is not None else None
+        if self.geometry is None:
+            raise RuntimeError(f"找不到目标窗口: {self.title}")
+        get_logger().info(f"目标窗口 {self.title}: 位置 {self.geometry}")
+        return self
+
+    def check(self):
+        """确认窗口位置是否变化，返回是否移动过"""
+        geometry = self.windows.geometry(self.handle)
+        if geometry is None:
+            get_logger().warning("目标窗口句柄失效，重新查找")
+            old = self.geometry
+            self.locate()
+            return self.geometry != old
+        if geometry != self.geometry:
+            get_logger().info(f"目标窗口已移动: {self.geometry} -> {geometry}")
+            self.geometry = geometry
+            return True
+        return False
+
+    def to_screen(self, x, y):
+        """窗口相对坐标 -> 屏幕坐标"""
+        return x + self.geometry[0], y + self.geometry[1]
+
+    def to_window(self, x, y):
+        """屏幕坐标 -> 窗口相对坐标"""
+        return x - self.geometry[0], y - self.geometry[1]
+
+    def close(self):
+        self.windows.close()
+
+
+class ScreenCapture:
+    """屏幕截图服务 - 复用截图句柄和缓冲区，只截取需要的区域
+
+    pyautogui.screenshot 每次都全屏截取再经 PIL 转换，耗时 50~150ms。
+    这里每个线程持有一个 mss 句柄（Linux 下走 XShm），每个区域对应一块
+    固定的 NumPy 缓冲区，点击、等待、校验等视觉功能共用这一套接口。
+    注意: grab 返回的数组会在同区域下次截取时被覆盖，需要保留请自行 copy。
+    """
+
+    def __init__(self):
+        # mss 句柄不能跨线程使用，缓冲区也按线程隔离
+        self._local = threading.local()
+
+    def _state(self):
+        state = self._local.__dict__
+        if 'buffers' not in state:
+            state['buffers'] = {}
+            state['sct'] = mss.mss() if mss is not None else None
+        return state
+
+    def _buffer(self, region, kind, shape, dtype):
+        buffers = self._state()['buffers']
+        key = (kind, region)
+        if key not in buffers:
+            buffers[key] = np.empty(shape, dtype=dtype)
+        return buffers[key]
+
+    def grab(self, region):
+        """截取区域 [x, y, w, h]，返回 BGRA uint8 数组（复用缓冲区）"""
+        region = tuple(int(v) for v in region)
+        x, y, w, h = region
+        buf = self._buffer(region, 'bgra', (h, w, 4), np.uint8)
+        sct = self._state()['sct']
+        if sct is not None:
+            shot = sct.grab({'left': x, 'top': y, 'width': w, 'height': h})
+            np.copyto(buf, np.frombuffer(shot.raw, dtype=np.uint8).reshape(h, w, 4))
+        else:
+            rgb = np.asarray(pyautogui.screenshot(region=region))
+            buf[..., 2::-1] = rgb[..., :3]
+            buf[..., 3] = 255
+        return buf
+
+    def grab_gray(self, region):
+        """截取区域并转为灰度 float32（复用缓冲区）"""
+        bgra = self.grab(region)
+        gray = self._buffer(tuple(int(v) for v in region), 'gray', bgra.shape[:2], np.float32)
+        np.sum(bgra[..., :3], axis=2, dtype=np.float32, out=gray)
+        return gray
+
+    def hash(self, region):
+        """区域的感知哈希"""
+        return region_hash(self.grab_gray(region))
+
+    def wait_match(self, region, expected, max_distance=6, timeout=1.0, interval=0.05):
+        """超时前反复截取，直到区域与任一期望哈希匹配
+
+        返回 (是否匹配, 最小距离)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.hash(region)
+            distance = min(hash_distance(current, e) for e in expected)
+            if distance <= max_distance:
+                return True, distance
+            if time.monotonic() >= deadline:
+                return False, distance
+            time.sleep(interval)
+
+    def wait_stable(self, region, timeout=5.0, interval=0.05, settle=2):
+        """等待区域画面稳定（连续 settle 次哈希不变），返回是否在超时前稳定"""
+        deadline = time.monotonic() + timeout
+        last, same = None, 0
+        while time.monotonic() < deadline:
+            current = self.hash(region)
+            same = same + 1 if current == last else 0
+            if same >= settle:
+                return True
+            last = current
+            time.sleep(interval)
+        return False
+
+    def close(self):
+        """释放当前线程的截图句柄"""
+        state = self._local.__dict__
+        if state.get('sct') is not None:
+            state['sct'].close()
+        state.clear()
+
+
+class RunJournal:
+    """运行流水 - 每行一条 JSON 记录，便于事后核对每条数据的处理结果
+
+    buffered=True 时只在内存中排队，由调用方择机 flush（异步运行模式下在后台线程写盘）。
+    """
+
+    def __init__(self, path, buffered=False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.buffered = buffered
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """追加一条记录"""
+        record = {'time': datetime.now().isoformat(timespec='seconds'), **record}
+        line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        with self.lock:
+            self.pending.append(line)
+        if not self.buffered:
+            self.flush()
+
+    def flush(self):
+        """把排队的记录写入文件"""
+        with self.lock:
+            lines, self.pending = self.pending, []
+        if lines:
+            self.file.write(''.join(lines))
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Metrics:
+    """运行指标 - 计数器、步骤耗时直方图、队列深度，输出 Prometheus 文本格式
+
+    更新只是加锁后的几次加法，导出由 MetricsExporter 在后台线程完成。
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {'success': 0, 'failed': 0, 'skipped': 0}
+        self.steps = {}  # 步骤名 -> [各桶计数..., 总次数, 总耗时]
+        self.remaining = 0
+        self.queued = 0
+        self.last_success = 0.0
+
+    def row(self, status):
+        """记录一行的处理结果"""
+        with self.lock:
+            self.rows[status] = self.rows.get(status, 0) + 1
+            if status == 'success':
+                self.last_success = time.time()
+
+    def observe_step(self, name, seconds):
+        """记录一个步骤的耗时"""
+        with self.lock:
+            hist = self.steps.setdefault(name, [0] * len(self.BUCKETS) + [0, 0.0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+
+    def set_remaining(self, rows):
+        """当前运行中尚未处理的行数"""
+        self.remaining = rows
+
+    def set_queued(self, rows):
+        """任务服务中排队等待的行数"""
+        self.queued = rows
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        with self.lock:
+            lines = ['# HELP bot_rows_total 已处理的行数', '# TYPE bot_rows_total counter']
+            lines += [f'bot_rows_total{{status="{k}"}} {v}' for k, v in self.rows.items()]
+            lines += ['# HELP bot_step_seconds 步骤耗时', '# TYPE bot_step_seconds histogram']
+            for name, hist in self.steps.items():
+                name = label(name)
+                lines += [f'bot_step_seconds_bucket{{step="{name}",le="{b}"}} {hist[i]}'
+                          for i, b in enumerate(self.BUCKETS)]
+                lines.append(f'bot_step_seconds_bucket{{step="{name}",le="+Inf"}} {hist[-2]}')
+                lines.append(f'bot_step_seconds_count{{step="{name}"}} {hist[-2]}')
+                lines.append(f'bot_step_seconds_sum{{step="{name}"}} {hist[-1]:.6f}')
+            lines += ['# HELP bot_queue_depth 等待处理的行数', '# TYPE bot_queue_depth gauge',
+                      f'bot_queue_depth {self.remaining + self.queued}',
+                      '# HELP bot_last_success_timestamp_seconds 最近一次成功处理的时间',
+                      '# TYPE bot_last_success_timestamp_seconds gauge',
+                      f'bot_last_success_timestamp_seconds {self.last_success:.3f}']
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """指标导出 - 后台线程定时原子地重写 textfile，和/或在本地端口提供 /metrics
+
+    配置 settings.metrics: {textfile: logs/bot.prom, port: 9108, interval: 5}
+    """
+
+    def __init__(self, metrics, options):
+        self.metrics = metrics
+        self.textfile = options.get('textfile')
+        if self.textfile and not Path(self.textfile).is_absolute():
+            self.textfile = BASE_DIR / self.textfile
+        self.port = options.get('port')
+        self.interval = options.get('interval', 5)
+        self.stopped = threading.Event()
+        self.httpd = None
+
+    def write_textfile(self):
+        """先写临时文件再替换，采集端不会读到写了一半的内容"""
+        path = Path(self.textfile)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(self.metrics.render(), encoding='utf-8')
+        os.replace(tmp, path)
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_textfile()
+            except OSError as e:
+                get_logger().warning(f"写入指标文件失败: {e}")
+
+    def start(self):
+        if self.textfile:
+            threading.Thread(target=self._loop, daemon=True).start()
+        if self.port:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, fmt, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            self.httpd = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """停止导出，并写出最终结果"""
+        self.stopped.set()
+        if self.textfile:
+            self.write_textfile()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+class SamplingProfiler:
+    """采样分析器 - 后台线程定时抓取所有线程的调用栈，开销很低
+
+    结果按调用栈聚合，输出折叠栈文本（flamegraph.pl 可用）和 speedscope JSON。
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.thread = None
+        self.stopped = threading.Event()
+        self.started_at = 0.0
+        self.duration = 0.0
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.stopped.clear()
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._loop, name='profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.duration += time.monotonic() - self.started_at
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def write(self, base_path):
+        """写出 <base>.collapsed.txt 和 <base>.speedscope.json，返回两个路径"""
+        base_path = Path(base_path)
+        base_path.parent.mkdir(parents=True, exist_ok=True)
+        collapsed = base_path.with_name(base_path.name + '.collapsed.txt')
+        with open(collapsed, 'w', encoding='utf-8') as f:
+            for (thread, stack), count in sorted(self.stacks.items()):
+                f.write(';'.join((thread,) + stack) + f" {count}\n")
+
+        frames, index = [], {}
+        profiles = {}
+        for (thread, stack), count in self.stacks.items():
+            ids = []
+            for name in stack:
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({'name': name})
+                ids.append(index[name])
+            profile = profiles.setdefault(thread, {'samples': [], 'weights': []})
+            profile['samples'].append(ids)
+            profile['weights'].append(count * self.interval)
+
+        speedscope = base_path.with_name(base_path.name + '.speedscope.json')
+        doc = {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': [{'type': 'sampled', 'name': thread, 'unit': 'seconds', 'startValue': 0,
+                          'endValue': sum(p['weights']), **p} for thread, p in profiles.items()],
+            'name': base_path.name,
+            'exporter': 'main_bot.SamplingProfiler',
+        }
+        with open(speedscope, 'w', encoding='utf-8') as f:
+            json.dump(doc, f, ensure_ascii=False)
+        return collapsed, speedscope
+
+
+class RunHistory:
+    """运行历史 - 每次运行的汇总存入本地 SQLite，用于对比不同配置/机器的吞吐"""
+
+    def __init__(self, path=None):
+        self.path = Path(path or BASE_DIR / "logs" / "history.db")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT, host TEXT, config_hash TEXT, mode TEXT,
+                rows INTEGER, success INTEGER, failed INTEGER, skipped INTEGER,
+                duration REAL, rows_per_min REAL, failure_rate REAL, step_p95 TEXT
+            )""")
+
+    def record(self, summary):
+        """保存一次运行的汇总"""
+        summary = dict(summary, step_p95=json.dumps(summary['step_p95'], ensure_ascii=False))
+        keys = ', '.join(summary)
+        marks = ', '.join('?' * len(summary))
+        with self.conn:
+            self.conn.execute(f"INSERT INTO runs ({keys}) VALUES ({marks})", list(summary.values()))
+
+    def row_seconds(self, config_hash, runs=5):
+        """该配置最近几次运行的平均每行耗时，没有记录时返回 None"""
+        rows = self.conn.execute(
+            "SELECT rows, duration FROM runs WHERE config_hash = ? AND rows > 0 ORDER BY id DESC LIMIT ?",
+            (config_hash, runs)).fetchall()
+        count = sum(r for r, _ in rows)
+        return sum(d for _, d in rows) / count if count else None
+
+    def groups(self, by='config_hash'):
+        """按配置或机器分组汇总，最近运行的组排在最后"""
+        rows = self.conn.execute(
+            f"SELECT {by}, rows, failed, duration, step_p95, started_at FROM runs WHERE rows > 0 ORDER BY id"
+        ).fetchall()
+        groups = {}
+        for key, count, failed, duration, p95, started in rows:
+            g = groups.pop(key, {'key': key, 'runs': 0, 'rows': 0, 'failed': 0, 'duration': 0.0, 'p95': {}})
+            g['runs'] += 1
+            g['rows'] += count
+            g['failed'] += failed
+            g['duration'] += duration
+            g['last'] = started
+            # 各次运行的 p95 按行数加权平均
+            for step, value in json.loads(p95).items():
+                total, weight = g['p95'].get(step, (0.0, 0))
+                g['p95'][step] = (total + value * count, weight + count)
+            groups[key] = g
+        for g in groups.values():
+            g['rows_per_min'] = g['rows'] / g['duration'] * 60 if g['duration'] else 0.0
+            g['failure_rate'] = g['failed'] / g['rows'] if g['rows'] else 0.0
+            g['p95'] = {step: total / weight for step, (total, weight) in g['p95'].items()}
+        return list(groups.values())
+
+    def compare(self, a=None, b=None, by='config_hash'):
+        """对比两组（默认最近的两组），返回说明文本行"""
+        groups = {g['key']: g for g in self.groups(by)}
+        if a is None or b is None:
+            keys = list(groups)[-2:]
+            if len(keys) < 2:
+                return ["历史记录不足两组，无法对比"]
+            a, b = keys
+        missing = [k for k in (a, b) if k not in groups]
+        if missing:
+            return [f"没有找到: {', '.join(missing)}"]
+        ga, gb = groups[a], groups[b]
+
+        def change(old, new):
+            return f"{(new - old) / old * 100:+.1f}%" if old else "-"
+
+        lines = [f"{'':<14}{a:>16}{b:>16}{'变化':>10}",
+                 f"{'运行次数':<14}{ga['runs']:>16}{gb['runs']:>16}",
+                 f"{'处理行数':<14}{ga['rows']:>16}{gb['rows']:>16}",
+                 f"{'行/分钟':<14}{ga['rows_per_min']:>16.1f}{gb['rows_per_min']:>16.1f}"
+                 f"{change(ga['rows_per_min'], gb['rows_per_min']):>10}",
+                 f"{'失败率':<14}{ga['failure_rate']:>16.2%}{gb['failure_rate']:>16.2%}"
+                 f"{(gb['failure_rate'] - ga['failure_rate']) * 100:>+9.2f}pt"]
+        for step in dict.fromkeys(list(ga['p95']) + list(gb['p95'])):
+            pa, pb = ga['p95'].get(step), gb['p95'].get(step)
+            lines.append(f"{'p95 ' + step:<14}{(f'{pa:.3f}s' if pa is not None else '-'):>16}"
+                         f"{(f'{pb:.3f}s' if pb is not None else '-'):>16}"
+                         f"{(change(pa, pb) if pa is not None and pb is not None else ''):>10}")
+        return lines
+
+    def close(self):
+        self.conn.close()
+
+
+# 影响吞吐的运行设置；预算、窗口、指标、日志等改动不算新的配置版本
+THROUGHPUT_SETTINGS = ('pacing', 'pacing_overrides', 'runner')
+
+
+def config_hash(config):
+    """步骤和影响吞吐的运行设置的指纹，用于区分配置版本"""
+    settings = config.get('settings') or {}
+    payload = json.dumps({'steps': config.get('steps'),
+                          'settings': {key: settings.get(key) for key in THROUGHPUT_SETTINGS}},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+
+
+ACTIONS = ('click', 'double_click', 'type_text', 'press_key', 'wait', 'clear_input', 'verify',
+           'probe', 'if', 'skip_row_if', 'repeat_until')
+
+
+def _validate_condition(cond, where, errors):
+    if not isinstance(cond, dict):
+        errors.append(f"{where}: 条件需要是字典")
+        return
+    if 'not' in cond:
+        _validate_condition(cond['not'], where, errors)
+    for key in ('all', 'any'):
+        for c in cond.get(key) or []:
+            _validate_condition(c, where, errors)
+    if 'column' in cond and cond.get('op', '==') not in COMPARE_OPS:
+        errors.append(f"{where}: 未知比较符 {cond.get('op')}")
+    if 'region' in cond and not _is_region(cond['region']):
+        errors.append(f"{where}: 条件区域格式应为 [x, y, 宽, 高]")
+    if 'region' in cond and not cond.get('template'):
+        errors.append(f"{where}: 屏幕区域条件需要 template")
+    if not {'not', 'all', 'any', 'column', 'region'} & set(cond):
+        errors.append(f"{where}: 条件缺少 column / region / not / all / any")
+
+
+def _is_region(region):
+    return isinstance(region, (list, tuple)) and len(region) == 4 and all(isinstance(v, int) for v in region)
+
+
+def _validate_steps(steps, prefix, errors):
+    if not isinstance(steps, list):
+        errors.append(f"{prefix or '步骤'}: 需要是列表")
+        return
+    for i, step in enumerate(steps, 1):
+        where = f"步骤 {prefix}{i}"
+        if not isinstance(step, dict):
+            errors.append(f"{where}: 需要是字典")
+            continue
+        action = step.get('action')
+        if action not in ACTIONS:
+            errors.append(f"{where}: 未知动作 {action}")
+            continue
+        if action in ('click', 'double_click') and not all(isinstance(step.get(k), int) for k in ('x', 'y')):
+            errors.append(f"{where}: 缺少整数坐标 x / y")
+        if action == 'type_text' and 'text' not in step:
+            errors.append(f"{where}: 缺少输入内容 text")
+        if action == 'press_key' and not step.get('key'):
+            errors.append(f"{where}: 缺少按键 key")
+        if action == 'verify' and (not _is_region(step.get('region')) or not step.get('template')):
+            errors.append(f"{where}: 屏幕校验需要 region [x, y, 宽, 高] 和 template")
+        if action == 'wait' and 'region' in step and not _is_region(step['region']):
+            errors.append(f"{where}: 等待区域格式应为 [x, y, 宽, 高]")
+        for key in ('wait_after', 'seconds', 'timeout', 'interval'):
+            if key in step and (not isinstance(step[key], (int, float)) or step[key] < 0):
+                errors.append(f"{where}: {key} 需要是非负数")
+        if action in ('if', 'skip_row_if', 'repeat_until'):
+            if 'when' not in step:
+                errors.append(f"{where}: 缺少 when 条件")
+            else:
+                _validate_condition(step['when'], where, errors)
+        for key in ('then', 'else', 'steps'):
+            if key in step:
+                _validate_steps(step[key] or [], f"{prefix}{i}.", errors)
+
+
+def _uses_relative(item):
+    """步骤或条件（含嵌套）里是否有窗口相对坐标"""
+    if isinstance(item, list):
+        return any(_uses_relative(i) for i in item)
+    if not isinstance(item, dict):
+        return False
+    return bool(item.get('relative')) or \
+        any(_uses_relative(item.get(key)) for key in ('when', 'not', 'all', 'any', 'then', 'else', 'steps'))
+
+
+def validate_config(config):
+    """检查配置结构，返回错误说明列表（空列表表示通过）"""
+    if not isinstance(config, dict):
+        return ["配置文件需要是 YAML 字典"]
+    errors = []
+    excel_cfg = config.get('excel')
+    if not isinstance(excel_cfg, dict):
+        errors.append("缺少 excel 设置")
+    else:
+        for key in ('code_column', 'quantity_column'):
+            if not excel_cfg.get(key):
+                errors.append(f"excel.{key} 未设置")
+    settings = config.get('settings') or {}
+    if not isinstance(settings, dict):
+        errors.append("settings 需要是字典")
+    else:
+        if settings.get('pacing', 'normal') not in PACING_PROFILES:
+            errors.append(f"未知节奏方案: {settings.get('pacing')}")
+        schedule = settings.get('schedule') or {}
+        if not isinstance(schedule, dict):
+            errors.append("settings.schedule 需要是字典")
+        else:
+            for key in ('budget', 'margin'):
+                if key in schedule and (not isinstance(schedule[key], (int, float))
+                                        or not math.isfinite(schedule[key]) or schedule[key] < 0):
+                    errors.append(f"settings.schedule.{key} 需要是非负数")
+            if 'priority' in schedule and not isinstance(schedule['priority'], str):
+                errors.append("settings.schedule.priority 需要是表达式文本")
+        window = settings.get('window') or {}
+        if not (isinstance(window, dict) and window.get('title')) and _uses_relative(config.get('steps')):
+            errors.append("步骤使用了窗口相对坐标 (relative: true)，需要设置目标窗口标题 settings.window.title")
+    _validate_steps(config.get('steps'), '', errors)
+    return errors
+
+
+def _describe_step(step):
+    return step.get('name') or step.get('action', '?')
+
+
+def diff_steps(old, new):
+    """对比新旧步骤列表，返回可读的变更说明列表
+
+    按 (名称, 动作) 对齐步骤，对齐上的步骤再逐字段比较。
+    """
+    identity = lambda step: (step.get('name'), step.get('action'))
+    matcher = difflib.SequenceMatcher(None, [identity(s) for s in old], [identity(s) for s in new], autojunk=False)
+    changes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('equal', 'replace') and i2 - i1 == j2 - j1:
+            for k in range(i2 - i1):
+                before, after = old[i1 + k], new[j1 + k]
+                fields = [f"{key}: {before.get(key, '-')} -> {after.get(key, '-')}"
+                          for key in dict.fromkeys([*before, *after]) if before.get(key) != after.get(key)]
+                if fields:
+                    changes.append(f"步骤 {j1 + k + 1} ({_describe_step(after)}) " + ", ".join(fields))
+            continue
+        for k in range(i1, i2):
+            changes.append(f"删除步骤 {k + 1} ({_describe_step(old[k])})")
+        for k in range(j1, j2):
+            changes.append(f"新增步骤 {k + 1} ({_describe_step(new[k])})")
+    return changes
+
+
+def write_config(path, config):
+    """写入配置文件：先写临时文件再替换，运行中的机器人不会读到写了一半的文件"""
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        yaml.dump(config, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+    os.replace(tmp, path)
+
+
+def expression_names(expr):
+    """表达式中出现的名称（含反引号括起的列名），用于决定额外读取哪些列"""
+    return {quoted or bare for quoted, bare in re.findall(r'`([^`]+)`|([^\W\d]\w*)', expr or '')}
+
+
+def profile_output_base(prefix='profile'):
+    """分析结果与日志放在同一目录"""
+    return BASE_DIR / "logs" / f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+
+def parse_budget(text):
+    """解析时间预算（分钟），空串为 0（不限）"""
+    value = float(text or 0)
+    if not (math.isfinite(value) and value >= 0):
+        raise ValueError(f"时间预算需要是非负的分钟数: {text}")
+    return value
+
+
+def parse_row_range(text):
+    """解析行范围 "100-150" 或 "100:150"，空串返回 None"""
+    text = (text or '').strip()
+    if not text:
+        return None
+    start, _, end = text.replace(':', '-').partition('-')
+    start, end = int(start), int(end or start)
+    if start < 1 or end < start:
+        raise ValueError(f"行范围无效: {text}")
+    return start, end
+
+
+# 单次输入事件本身的大致耗时（秒），用于估算
+EVENT_SECONDS = 0.01
+
+# 执行时会按 wait_after 等待的动作；其它动作（条件、循环、等待）的 wait_after 不生效
+WAIT_AFTER_ACTIONS = ('click', 'double_click', 'type_text', 'press_key', 'clear_input', 'probe', 'verify')
+
+
+def step_events(step):
+    """步骤会发出的输入事件 [(节奏类型, 次数)]"""
+    action = step.get('action')
+    if action in ('click', 'double_click'):
+        return [('click', 1)]
+    if action == 'type_text':
+        return ([('select', 1)] if step.get('clear_first') else []) + [('paste', 1)]
+    if action == 'press_key':
+        return [('hotkey' if '+' in str(step.get('key', '')) else 'press', 1)]
+    if action == 'clear_input':
+        return [('select', 1), ('press', 1)]
+    if action == 'probe':
+        return [('click', 1 if 'x' in step else 0), ('select', 1), ('hotkey', 1)]
+    return []
+
+
+def estimate_row_seconds(steps, pacing='normal'):
+    """粗略估算一行的耗时：等待时间 + 输入事件 + 未被等待覆盖的节奏间隔"""
+    delays = PACING_PROFILES.get(pacing, PACING_PROFILES['normal'])
+    total = 0.0
+    idle = 0.0  # 上一次输入后已经等待的时间
+    for step in steps:
+        for kind, count in step_events(step):
+            for _ in range(count):
+                total += EVENT_SECONDS + max(0.0, delays.get(kind, 0) - idle)
+                idle = 0.0
+        waited = (step.get('wait_after', 0) or 0) if step.get('action') in WAIT_AFTER_ACTIONS else 0
+        if step.get('action') == 'wait':
+            waited += step.get('seconds', 1)
+        total += waited
+        idle += waited
+    return total
+
+
+def is_select_all(step):
+    """步骤是否只是全选（Ctrl+A）"""
+    return step.get('action') == 'press_key' and str(step.get('key', '')).lower().replace(' ', '') == 'ctrl+a'
+
+
+def optimize_steps(steps, rows=1, pacing='normal'):
+    """优化步骤列表：合并相邻等待、去掉重复全选，并标出可疑的冗余
+
+    只处理顶层步骤，条件/循环步骤原样保留并作为边界。
+    返回 (优化后的步骤, 发现列表, 每行节省秒数, 整批节省秒数)，
+    发现列表每项为 {'step': 序号, 'kind': 'merge'/'flag', 'message': 说明}，
+    提示项另有 'saving'：按建议修改后每行预计节省的秒数。
+    """
+    findings = []
+    result = []
+    for i, step in enumerate(steps, 1):
+        step = dict(step)
+        prev = result[-1] if result else None
+        action = step.get('action')
+
+        # 固定时长的等待步骤并入上一个固定等待，或上一步的 wait_after（只并入确实会等待的动作）
+        mergeable = prev is not None and (prev.get('action') in WAIT_AFTER_ACTIONS
+                                          or (prev.get('action') == 'wait' and not prev.get('region')))
+        if action == 'wait' and not step.get('region') and mergeable:
+            seconds = step.get('seconds', 1)
+            if prev.get('action') == 'wait':
+                prev['seconds'] = round(prev.get('seconds', 1) + seconds, 3)
+                message = f"等待 {seconds} 秒与上一个等待相邻，已合并为一步"
+            else:
+                prev['wait_after'] = round((prev.get('wait_after') or 0) + seconds, 3)
+                message = f"等待 {seconds} 秒已并入上一步「{_describe_step(prev)}」的操作后等待"
+            findings.append({'step': i, 'kind': 'merge', 'message': message})
+            continue
+
+        # 前一步已经全选（或清空），本步的 clear_first 重复
+        if action == 'type_text' and step.get('clear_first') and prev is not None \
+                and (is_select_all(prev) or prev.get('action') == 'clear_input') and not prev.get('wait_after'):
+            del step['clear_first']
+            findings.append({'step': i, 'kind': 'merge',
+                             'message': "上一步已全选/清空，去掉重复的「输入前先清空」"})
+        elif is_select_all(step) and prev is not None and is_select_all(prev) and not prev.get('wait_after'):
+            findings.append({'step': i, 'kind': 'merge', 'message': "连续两次 Ctrl+A，已去掉第二次"})
+            continue
+
+        # 以下只提示，不自动修改；saving 为按建议修改后每行预计节省的秒数
+        before = estimate_row_seconds(result + [step], pacing)
+        if action == 'type_text' and step.get('clear_first') and prev is not None \
+                and prev.get('action') in ('click', 'double_click'):
+            without = {k: v for k, v in step.items() if k != 'clear_first'}
+            findings.append({'step': i, 'kind': 'flag',
+                             'saving': round(before - estimate_row_seconds(result + [without], pacing), 3),
+                             'message': "点击输入框后紧接着全选；若点击后内容已被选中，可去掉「输入前先清空」"})
+        if action == 'verify' and prev is not None and (prev.get('wait_after') or 0) > step.get('timeout', 1.0):
+            shorter = {**prev, 'wait_after': step.get('timeout', 1.0)}
+            findings.append({'step': i, 'kind': 'flag',
+                             'saving': round(before - estimate_row_seconds(result[:-1] + [shorter, step], pacing), 3),
+                             'message': f"校验本身会轮询 {step.get('timeout', 1.0)} 秒，上一步的等待 {prev['wait_after']} 秒可以缩短"})
+        if action == 'type_text':
+            for j, other in enumerate(steps[:i - 1], 1):
+                if other.get('action') == 'type_text' and other.get('text') == step.get('text') \
+                        and other.get('wait_after') == step.get('wait_after'):
+                    findings.append({'step': i, 'kind': 'flag',
+                                     'saving': round(before - estimate_row_seconds(result, pacing), 3),
+                                     'message': f"与第 {j} 步输入相同内容 {step.get('text')}，等待也相同；"
+                                                "若第二个界面会自动带出该值，可删除本步"})
+                    break
+
+        result.append(step)
+
+    saved = max(0.0, estimate_row_seconds(steps, pacing) - estimate_row_seconds(result, pacing))
+    return result, findings, saved, saved * rows
+
+
 # 日志配置 - 延迟初始化
 _logger = None
+# 当前运行编号，写入每条文件日志
+_run_id = '-'
+
+# 日志归档默认值：单个日志超过 max_mb 或写满 rotate_hours 后轮转压缩，归档保留 keep_days 天
+LOG_OPTIONS = {'max_mb': 10, 'rotate_hours': 24, 'keep_days': 90}
+
+
+def set_run_id(run_id):
+    global _run_id
+    _run_id = run_id or '-'
+
+
+class RunIdFilter(logging.Filter):
+    """给日志记录补上当前运行编号"""
+
+    def filter(self, record):
+        if not hasattr(record, 'run_id'):
+            record.run_id = _run_id
+        return True
+
+
+class LogIndex:
+    """日志索引 - 编码 -> (运行编号, 日志文件, 偏移)，存在 logs/log_index.db
+
+    写入先缓存在内存中，攒够一批或间隔几秒再提交，不拖慢逐行处理。
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or BASE_DIR / "logs" / "log_index.db")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                code TEXT, run_id TEXT, file TEXT, offset INTEGER, time REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_code ON entries (code, time)")
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.committed_at = time.monotonic()
+
+    def add(self, code, run_id, file, offset, created, batch=50, interval=5.0):
+        with self.lock:
+            self.buffer.append((str(code), run_id, file, offset, created))
+            if len(self.buffer) >= batch or time.monotonic() - self.committed_at > interval:
+                self._commit()
+
+    def _commit(self):
+        if self.buffer:
+            with self.conn:
+                self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", self.buffer)
+            self.buffer = []
+        self.committed_at = time.monotonic()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def rename(self, old, new):
+        """日志文件轮转改名后，更新指向它的索引"""
+        with self.lock:
+            self._commit()
+            with self.conn:
+                self.conn.execute("UPDATE entries SET file = ? WHERE file = ?", (new, old))
+
+    def forget(self, files):
+        """归档删除后，去掉对应的索引"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("DELETE FROM entries WHERE file = ?", [(f,) for f in files])
+
+    def lookup(self, code, limit=1):
+        """编码最近的记录，新的在前: [(运行编号, 时间, 文件, 偏移)]"""
+        with self.lock:
+            self._commit()
+            return self.conn.execute(
+                "SELECT run_id, time, file, offset FROM entries WHERE code = ? ORDER BY time DESC LIMIT ?",
+                (str(code), limit)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+
+def read_log_entry(file, offset, max_lines=30):
+    """从日志文件的偏移处读出该行的处理记录（到下一行或运行汇总为止），归档文件自动解压"""
+    path = BASE_DIR / "logs" / file
+    if not path.exists():
+        path = path.with_name(path.name + '.gz')
+    if not path.exists():
+        return [f"(日志文件已删除: {file})"]
+    with (gzip.open(path, 'rb') if path.suffix == '.gz' else open(path, 'rb')) as f:
+        f.seek(offset)
+        lines = []
+        for raw in f:
+            line = raw.decode('utf-8', errors='replace').rstrip('\n')
+            if lines and ('] 处理: ' in line or '=' * 20 in line or len(lines) >= max_lines):
+                break
+            lines.append(line)
+    return lines
+
+
+def try_lock(f):
+    """对已打开的文件加非阻塞排它锁，已被其它进程锁住时返回 False"""
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class ArchiveHandler(logging.handlers.RotatingFileHandler):
+    """按大小和时间轮转的日志文件，旧文件在后台线程压缩到 logs/archive/
+
+    带 item_code 的记录（extra={'item_code': 编码}）写入时记下偏移，存入 LogIndex。
+    """
+
+    def __init__(self, path, index, max_mb=10, rotate_hours=24, keep_days=90):
+        super().__init__(str(path), maxBytes=int(max_mb * 1024 * 1024), encoding='utf-8', delay=True)
+        self.index = index
+        self.archive_dir = Path(path).parent / "archive"
+        # 当前文件的开始时间；按时间轮转总是从这里算起
+        self.segment_started = time.time()
+        self.rotate_seconds = None
+        self.configure(max_mb, rotate_hours, keep_days)
+        # 占用标记：进程存活期间一直锁住，其它进程归档旧日志时据此跳过仍在使用的文件
+        self.owner_lock = open(str(path) + '.lock', 'w')
+        try_lock(self.owner_lock)
+        self.segment = 0
+        self.workers = []
+
+    def configure(self, max_mb=None, rotate_hours=None, keep_days=None):
+        """每次创建机器人都会调用；轮转间隔不变时不推迟下次轮转"""
+        if max_mb is not None:
+            self.maxBytes = int(max_mb * 1024 * 1024)
+        if rotate_hours is not None and rotate_hours * 3600 != self.rotate_seconds:
+            self.rotate_seconds = rotate_hours * 3600
+            self.rollover_at = self.segment_started + self.rotate_seconds
+        if keep_days is not None:
+            self.keep_days = keep_days
+
+    def _relative(self, path):
+        return Path(path).relative_to(BASE_DIR / "logs").as_posix()
+
+    def shouldRollover(self, record):
+        if record.created >= self.rollover_at and os.path.exists(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def emit(self, record):
+        code = getattr(record, 'item_code', None)
+        if code is None:
+            return super().emit(record)
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            offset = self.stream.tell()
+            logging.FileHandler.emit(self, record)
+            self.index.add(code, getattr(record, 'run_id', _run_id), self._relative(self.baseFilename),
+                           offset, record.created)
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        """当前文件改名移入归档目录，压缩和清理交给后台线程"""
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.segment_started = time.time()
+        self.rollover_at = self.segment_started + self.rotate_seconds
+        if not os.path.exists(self.baseFilename):
+            return
+        self.segment += 1
+        base = Path(self.baseFilename)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        target = self.archive_dir / f"{base.stem}_{self.segment:03d}{base.suffix}"
+        os.replace(base, target)
+        self.index.rename(self._relative(base), self._relative(target))
+        self.compress_later(target)
+
+    def compress_later(self, path):
+        worker = threading.Thread(target=self._compress, args=(path,), name='log-archive')
+        worker.start()
+        self.workers = [w for w in self.workers if w.is_alive()] + [worker]
+
+    def _compress(self, path):
+        try:
+            with open(path, 'rb') as src, gzip.open(str(path) + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+            self.prune()
+        except OSError as e:
+            print(f"警告: 压缩日志失败 {path}: {e}")
+
+    def prune(self):
+        """删除超过保留天数的归档及其索引"""
+        cutoff = time.time() - self.keep_days * 86400
+        expired = [p for p in self.archive_dir.glob('*.log.gz') if p.stat().st_mtime < cutoff]
+        for p in expired:
+            p.unlink(missing_ok=True)
+        if expired:
+            self.index.forget([self._relative(p.with_suffix('')) for p in expired])
+
+    def archive_stale(self, max_age):
+        """上次会话留下、已不再写入的日志一并归档；其它进程仍锁着的日志（如空闲的任务服务）跳过"""
+        now = time.time()
+        for path in self.archive_dir.parent.glob('bot_*.log'):
+            if str(path) == self.baseFilename or now - path.stat().st_mtime <= max_age:
+                continue
+            marker = Path(str(path) + '.lock')
+            with open(marker, 'a') as f:
+                if not try_lock(f):
+                    continue
+                target = self.archive_dir / path.name
+                self.archive_dir.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.replace(path, target)
+                except OSError:
+                    continue
+            marker.unlink(missing_ok=True)
+            self.index.rename(self._relative(path), self._relative(target))
+            self.compress_later(target)
+
+    def close(self):
+        super().close()
+        if not self.owner_lock.closed:
+            self.owner_lock.close()
+            Path(self.baseFilename + '.lock').unlink(missing_ok=True)
+        self.index.commit()
+        for worker in self.workers:
+            worker.join()
+
+
+def archive_handler():
+    """当前的日志归档处理器（未启用时为 None）"""
+    get_logger()
+    return next((h for h in logging.getLogger().handlers if isinstance(h, ArchiveHandler)), None)
+
+
+def configure_log_archive(options):
+    """按 settings.logging 调整轮转大小、时间和保留天数"""
+    if options and (handler := archive_handler()):
+        handler.configure(options.get('max_mb'), options.get('rotate_hours'), options.get('keep_days'))
+
 
 def get_logger():
     """获取日志器（延迟初始化）"""
@@ -41,12 +1363,16 @@ def get_logger():
     if _logger is not None:
         return _logger
 
+    run_filter = RunIdFilter()
     try:
         log_dir = BASE_DIR / "logs"
         log_dir.mkdir(parents=True, exist_ok=True)
         log_file = log_dir / f"bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        file_handler = ArchiveHandler(log_file, LogIndex(), **LOG_OPTIONS)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] [%(run_id)s] %(message)s'))
+        file_handler.archive_stale(LOG_OPTIONS['rotate_hours'] * 3600)
         handlers = [
-            logging.FileHandler(str(log_file), encoding='utf-8'),
+            file_handler,
             logging.StreamHandler(sys.stdout)
         ]
     except Exception as e:
@@ -54,36 +1380,191 @@ def get_logger():
         print(f"警告: 无法创建日志文件: {e}")
         handlers = [logging.StreamHandler(sys.stdout)]
 
+    for handler in handlers:
+        handler.addFilter(run_filter)
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s [%(levelname)s] %(message)s',
         handlers=handlers
     )
     _logger = logging.getLogger(__name__)
+    _logger.addFilter(run_filter)
     return _logger
 
 
 class AutomationBot:
     """自动化机器人核心类"""
 
-    def __init__(self, config_path="config.yaml"):
+    def __init__(self, config_path="config.yaml", progress=None, metrics=None):
         # 处理配置文件路径
         config_path = Path(config_path)
         if not config_path.is_absolute():
             config_path = BASE_DIR / config_path
+        self.config_path = config_path
+        self.config_mtime = config_path.stat().st_mtime_ns
         self.config = self.load_config(config_path)
+        if errors := validate_config(self.config):
+            raise ValueError("配置文件校验失败:\n" + "\n".join(errors))
         self.assets_dir = BASE_DIR / "assets"
         self.stats = {"success": 0, "failed": 0, "skipped": 0}
+        # 进度通道：每行结束推送一份统计快照，由界面按固定频率读取
+        self.progress = progress
+        self.journal = None
+        # 当前行的附加信息（如探测到的原值），写入运行流水
+        self.row_info = {}
+        # 预先渲染好的当前行文本 {id(步骤): 文本}，异步模式下由事件循环提前准备
+        self.row_texts = {}
+        self.template_hashes = {}
+        self.capture = ScreenCapture()
+        self.plan = self.compile_steps(self.config['steps'])
+        settings = self.config.get('settings') or {}
+        configure_log_archive(settings.get('logging'))
+        self.run_id = None
+        self.pacer = Pacer(settings.get('pacing', 'normal'), settings.get('pacing_overrides'))
+        self.backend = None
+        # 由外部传入时（任务服务）指标跨多次运行累计，导出也由外部负责
+        self.own_metrics = metrics is None
+        self.metrics = metrics or Metrics()
+        # 本次运行各步骤的耗时，用于历史记录里的 p95
+        self.step_durations = {}
+        # 时间预算：截止时间、每行耗时估计、预算用完时剩下的行，以及超出 limit 未排入本次的行
+        self.schedule = settings.get('schedule') or {}
+        self.deadline = None
+        self.row_cost = None
+        self.leftover = []
+        self.dropped = []
+        self.pending_path = BASE_DIR / "logs" / "pending_rows.json"
+        # 目标窗口锚点，配置 settings.window.title 时启用
+        self.window_title = (settings.get('window') or {}).get('title')
+        self.anchor = None
 
     def load_config(self, path):
         """加载配置文件"""
         with open(path, 'r', encoding='utf-8') as f:
             return yaml.safe_load(f)
 
-    def load_excel(self):
-        """读取 Excel 数据"""
+    def _aliases(self):
+        excel_cfg = self.config['excel']
+        return {'code': excel_cfg['code_column'], 'quantity': excel_cfg['quantity_column']}
+
+    def compile_steps(self, steps):
+        """编译步骤列表：预先解析文本模板和条件，返回执行计划（不修改原配置）"""
+        aliases = self._aliases()
+        plan = []
+        for step in steps:
+            step = dict(step)
+            if 'text' in step:
+                step['_template'] = TextTemplate(str(step['text']), aliases)
+            if step.get('action') == 'probe':
+                step['_compare'] = TextTemplate(str(step.get('compare', '{quantity}')), aliases)
+            if 'when' in step:
+                step['when'] = self.compile_condition(step['when'])
+            # 分支和循环体递归编译
+            for key in ('then', 'else', 'steps'):
+                if key in step:
+                    step[key] = self.compile_steps(step[key] or [])
+            plan.append(step)
+        return plan
+
+    def compile_condition(self, cond):
+        """编译条件：列名解析别名，比较值预解析为模板"""
+        if not isinstance(cond, dict):
+            raise ValueError(f"条件格式错误: {cond}")
+        cond = dict(cond)
+        if 'not' in cond:
+            cond['not'] = self.compile_condition(cond['not'])
+        for key in ('all', 'any'):
+            if key in cond:
+                cond[key] = [self.compile_condition(c) for c in cond[key]]
+        if 'column' in cond:
+            cond['column'] = self._aliases().get(cond['column'], cond['column'])
+            cond['_template'] = TextTemplate(str(cond.get('value', '')), self._aliases())
+        return cond
+
+    def iter_plan(self, plan=None):
+        """遍历执行计划中的所有步骤（含分支和循环体内的步骤）"""
+        for step in self.plan if plan is None else plan:
+            yield step
+            for key in ('then', 'else', 'steps'):
+                yield from self.iter_plan(step.get(key, []))
+
+    def _condition_columns(self, cond):
+        if 'column' in cond:
+            yield cond['column']
+            yield from cond['_template'].columns
+        if 'not' in cond:
+            yield from self._condition_columns(cond['not'])
+        for c in cond.get('all', []) + cond.get('any', []):
+            yield from self._condition_columns(c)
+
+    def referenced_columns(self, plan=None):
+        """执行计划实际用到的 Excel 列（编码列和库存列总是需要）"""
         excel_cfg = self.config['excel']
-        raw_path = excel_cfg.get('file_path', '')
+        columns = [excel_cfg['code_column'], excel_cfg['quantity_column']]
+        for step in self.iter_plan(plan):
+            used = list(step['_template'].columns) if '_template' in step else []
+            if '_compare' in step:
+                used += step['_compare'].columns
+            if 'when' in step:
+                used += self._condition_columns(step['when'])
+            columns += [c for c in dict.fromkeys(used) if c not in columns]
+        return columns
+
+    def reload_config(self, columns=None):
+        """配置文件有改动时重新加载，校验通过后在两行之间整体换上新的执行计划
+
+        只在行与行之间调用，正在执行的行不受影响。columns 为已读取的数据列，
+        新步骤引用了未读取的列时拒绝加载。返回是否换上了新计划。
+        """
+        try:
+            mtime = self.config_path.stat().st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.config_mtime:
+            return False
+        self.config_mtime = mtime
+        logger = get_logger()
+        try:
+            config = self.load_config(self.config_path)
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f"配置文件已修改但无法读取，继续使用原配置: {e}")
+            return False
+        errors = validate_config(config)
+        if errors:
+            logger.warning("配置文件已修改但校验失败，继续使用原配置:")
+            for error in errors:
+                logger.warning(f"  {error}")
+            return False
+        if config['excel'] != self.config['excel']:
+            logger.warning("Excel 设置的改动需要重新运行才会生效")
+            config['excel'] = self.config['excel']
+        try:
+            plan = self.compile_steps(config['steps'])
+        except ValueError as e:
+            logger.warning(f"配置文件已修改但编译失败，继续使用原配置: {e}")
+            return False
+        missing = [c for c in self.referenced_columns(plan) if columns is not None and c not in columns]
+        if missing:
+            logger.warning(f"新步骤引用了未读取的列 {', '.join(missing)}，需要重新运行，继续使用原配置")
+            return False
+
+        settings = config.get('settings') or {}
+        old_settings = self.config.get('settings') or {}
+        if (settings.get('pacing', 'normal'), settings.get('pacing_overrides')) != \
+                (old_settings.get('pacing', 'normal'), old_settings.get('pacing_overrides')):
+            self.pacer.configure(settings.get('pacing', 'normal'), settings.get('pacing_overrides'))
+            logger.info(f"节奏方案切换为 {self.pacer.profile}")
+        changes = diff_steps(self.config['steps'], config['steps'])
+        self.config = config
+        self.plan = plan
+        logger.info(f"已重新加载配置 ({len(changes)} 处步骤改动)")
+        for change in changes:
+            logger.info(f"  {change}")
+        return True
+
+    def excel_file(self):
+        """Excel 文件的绝对路径"""
+        raw_path = self.config['excel'].get('file_path', '')
 
         # 验证路径不为空
         if not raw_path or not raw_path.strip():
@@ -94,6 +1575,12 @@ class AutomationBot:
         # 处理相对路径
         if not file_path.is_absolute():
             file_path = BASE_DIR / file_path
+        return file_path
+
+    def load_excel(self):
+        """读取 Excel 数据"""
+        excel_cfg = self.config['excel']
+        file_path = self.excel_file()
 
         # 验证文件存在
         if not file_path.exists():
@@ -104,28 +1591,151 @@ class AutomationBot:
 
         get_logger().info(f"读取 Excel: {file_path}")
 
+        # 只读取步骤里引用到的列，以及优先级表达式用到的列
+        columns = set(self.referenced_columns()) | expression_names(self.schedule.get('priority'))
         df = pd.read_excel(
             file_path,
-            sheet_name=excel_cfg.get('sheet_name') or 0
+            sheet_name=excel_cfg.get('sheet_name') or 0,
+            usecols=lambda c: c in columns
         )
 
+        records = self.clean_frame(df)
+        get_logger().info(f"共读取 {len(records)} 条有效数据")
+        return records
+
+    def clean_frame(self, df, keep_extra=False):
+        """校验并清洗数据表，返回行字典列表
+
+        默认只保留步骤用到的列；keep_extra 为 True 时保留全部列，供之后按新配置重新校验。
+        """
+        excel_cfg = self.config['excel']
         code_col = excel_cfg['code_column']
         qty_col = excel_cfg['quantity_column']
+        columns = self.referenced_columns()
 
         # 数据校验
-        if code_col not in df.columns:
-            raise ValueError(f"找不到列: {code_col}")
-        if qty_col not in df.columns:
-            raise ValueError(f"找不到列: {qty_col}")
+        for col in columns:
+            if col not in df.columns:
+                raise ValueError(f"找不到列: {col}")
+
+        # 优先级表达式用到、且表中存在的列一并保留
+        columns += [c for c in expression_names(self.schedule.get('priority')) if c in df.columns and c not in columns]
 
         # 清洗数据
-        df = df[[code_col, qty_col]].dropna()
+        df = (df.copy() if keep_extra else df[columns]).dropna(subset=[code_col, qty_col])
         df[code_col] = df[code_col].astype(str).str.strip()
         df[qty_col] = pd.to_numeric(df[qty_col], errors='coerce').fillna(0).astype(int)
-
-        get_logger().info(f"共读取 {len(df)} 条有效数据")
         return df.to_dict('records')
 
+    def parse_rows(self, body, content_type='application/json'):
+        """解析提交的数据：JSON（行列表或 {"rows": [...]}）或 CSV 文本"""
+        if 'csv' in content_type:
+            df = pd.read_csv(io.StringIO(body.decode('utf-8-sig')), dtype=str)
+        else:
+            payload = json.loads(body.decode('utf-8'))
+            rows = payload.get('rows') if isinstance(payload, dict) else payload
+            if not isinstance(rows, list):
+                raise ValueError("JSON 需要是行列表或 {\"rows\": [...]}")
+            df = pd.DataFrame(rows)
+        # 保留上传的全部列：执行时的配置可能已经修改，由任务线程按当时的配置再校验一次
+        return self.clean_frame(df, keep_extra=True)
+
+    def prioritize(self, data_list):
+        """按 settings.schedule.priority 对整批数据一次性计算优先级，从高到低排序"""
+        expr = self.schedule.get('priority')
+        if not expr or not data_list:
+            return data_list
+        try:
+            values = pd.DataFrame(data_list).eval(expr)
+            values = pd.to_numeric(pd.Series(values), errors='coerce').fillna(float('-inf')).to_numpy()
+        except Exception as e:
+            raise ValueError(f"优先级表达式无效: {expr} ({e})")
+        if len(values) != len(data_list):
+            raise ValueError(f"优先级表达式需要对每行给出一个值: {expr}")
+        order = np.argsort(-values, kind='stable')
+        get_logger().info(f"按优先级排序: {expr}，最高 {values[order[0]]:g}，最低 {values[order[-1]]:g}")
+        return [data_list[i] for i in order]
+
+    def load_pending(self):
+        """上次因时间预算未处理完的行；Excel 已更新或步骤引用了队列里没有的列时作废"""
+        if not self.pending_path.exists():
+            return None
+        logger = get_logger()
+        try:
+            pending = json.loads(self.pending_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取待处理队列失败，忽略: {e}")
+            return None
+        excel_path = self.excel_file()
+        if pending.get('excel') != str(excel_path) or \
+                not excel_path.exists() or pending.get('excel_mtime') != excel_path.stat().st_mtime_ns:
+            logger.info("Excel 在上次运行后有变化，忽略上次剩下的行")
+            self.pending_path.unlink()
+            return None
+        # 队列按保存时的步骤只保留了用到的列，步骤修改后需要重新校验
+        try:
+            rows = self.clean_frame(pd.DataFrame(pending['rows']), keep_extra=True)
+        except ValueError as e:
+            logger.warning(f"上次剩下的行不符合当前步骤 ({e})，放弃该队列，重新读取 Excel")
+            self.pending_path.unlink()
+            return None
+        logger.info(f"继续上次未处理完的 {len(rows)} 行 (保存于 {pending.get('saved_at')})")
+        return rows
+
+    def save_pending(self, rows):
+        """保存尚未处理的行，下次运行优先处理；没有剩余时清空队列"""
+        if not rows:
+            self.pending_path.unlink(missing_ok=True)
+            return
+        excel_path = self.excel_file()
+        payload = {'excel': str(excel_path), 'excel_mtime': excel_path.stat().st_mtime_ns,
+                   'saved_at': datetime.now().isoformat(timespec='seconds'), 'rows': rows}
+        self.pending_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.pending_path.with_name(self.pending_path.name + '.tmp')
+        tmp.write_text(json.dumps(payload, ensure_ascii=False, default=str), encoding='utf-8')
+        os.replace(tmp, self.pending_path)
+        get_logger().info(f"剩余 {len(rows)} 行已保存到 {self.pending_path.name}，下次运行继续")
+
+    def start_budget(self, minutes, total):
+        """开始计时：按近期吞吐估算每行耗时，预算不够时提前说明"""
+        self.leftover = []
+        if not minutes:
+            self.deadline = None
+            return
+        if not (math.isfinite(minutes) and minutes > 0):
+            raise ValueError(f"时间预算需要是非负的分钟数: {minutes}")
+        self.deadline = time.monotonic() + minutes * 60
+        try:
+            history = RunHistory()
+            self.row_cost = history.row_seconds(config_hash(self.config))
+            history.close()
+        except sqlite3.Error:
+            self.row_cost = None
+        source = "历史记录"
+        if not self.row_cost:
+            self.row_cost = estimate_row_seconds(self.config['steps'], self.pacer.profile) or 1.0
+            source = "步骤估算"
+        fits = int(minutes * 60 / self.row_cost)
+        get_logger().info(f"时间预算 {minutes:g} 分钟，每行约 {self.row_cost:.2f} 秒 ({source})，"
+                          f"预计可处理 {min(fits, total)}/{total} 行")
+
+    def observe_row_cost(self, seconds, alpha=0.2):
+        """用最近的行耗时更新估计（指数滑动平均）"""
+        if self.row_cost is not None:
+            self.row_cost += alpha * (seconds - self.row_cost)
+
+    def within_budget(self, data_list, i):
+        """第 i 行开始前检查剩余时间，不够完成一行时停下并记下剩余的行（含队列里超出 limit 的行）"""
+        if self.deadline is None:
+            return True
+        remaining = self.deadline - time.monotonic()
+        if remaining >= self.row_cost * self.schedule.get('margin', 1.5):
+            return True
+        self.leftover = data_list[i - 1:] + self.dropped
+        get_logger().info(f"时间预算剩余 {max(remaining, 0):.1f} 秒，不足以完成一行 (约 {self.row_cost:.2f} 秒)，"
+                          f"停止运行，剩余 {len(self.leftover)} 行")
+        return False
+
     def execute_action(self, step, data):
         """执行单个操作步骤"""
         action = step['action']
@@ -146,56 +1756,86 @@ class AutomationBot:
             return self._action_press_key(step)
 
         elif action == 'wait':
+            self.backend.flush()
+            if step.get('region'):
+                return self._action_wait_stable(step)
             time.sleep(step.get('seconds', 1))
             return True
 
         elif action == 'clear_input':
-            pyautogui.hotkey('ctrl', 'a')
-            pyautogui.press('delete')
+            self._input('select', self.backend.hotkey, 'ctrl', 'a')
+            self._input('press', self.backend.press, 'delete')
+            self._wait_after(step)
             return True
 
+        elif action == 'verify':
+            return self._action_verify(step)
+
         else:
             get_logger().warning(f"未知动作: {action}")
             return False
 
+    def _input(self, kind, func, *args):
+        """发出一次输入事件，前面按节奏方案补足间隔"""
+        self.pacer.wait(kind, before_sleep=self.backend.flush)
+        func(*args)
+        self.pacer.mark()
+
+    def _wait_after(self, step):
+        """步骤结束：送出缓冲的输入事件，再按 wait_after 等待"""
+        self.backend.flush()
+        if wait := step.get('wait_after'):
+            time.sleep(wait)
+
+    def _point(self, step):
+        """步骤坐标换算为屏幕坐标，relative 步骤相对目标窗口"""
+        x, y = step.get('x'), step.get('y')
+        if x is None or y is None or not step.get('relative'):
+            return x, y
+        if self.anchor is None:
+            raise RuntimeError("步骤使用窗口相对坐标，但未配置目标窗口标题 (settings.window.title)")
+        return self.anchor.to_screen(x, y)
+
+    def _region(self, item):
+        """区域换算为屏幕坐标，relative 区域相对目标窗口"""
+        region = item.get('region')
+        if not region or not item.get('relative'):
+            return region
+        if self.anchor is None:
+            raise RuntimeError("区域使用窗口相对坐标，但未配置目标窗口标题 (settings.window.title)")
+        x, y = self.anchor.to_screen(region[0], region[1])
+        return [x, y, region[2], region[3]]
+
     def _action_click(self, step, double=False):
         """点击操作 - 使用坐标"""
-        x = step.get('x')
-        y = step.get('y')
+        x, y = self._point(step)
 
         if x is None or y is None:
             get_logger().error("未设置坐标")
             return False
 
         if double:
-            pyautogui.doubleClick(x, y)
+            self._input('click', self.backend.double_click, x, y)
         else:
-            pyautogui.click(x, y)
+            self._input('click', self.backend.click, x, y)
 
-        if wait := step.get('wait_after'):
-            time.sleep(wait)
+        self._wait_after(step)
         return True
 
     def _action_type(self, step, data):
         """输入文本"""
-        text = step.get('text', '')
-        code_col = self.config['excel']['code_column']
-        qty_col = self.config['excel']['quantity_column']
-
-        # 替换占位符
-        text = text.replace('{code}', str(data.get(code_col, '')))
-        text = text.replace('{quantity}', str(data.get(qty_col, '')))
+        text = self.row_texts.get(id(step))
+        if text is None:
+            template = step.get('_template') or self.compile_steps([step])[0].get('_template')
+            text = template.render(data) if template else ''
 
         if step.get('clear_first'):
-            pyautogui.hotkey('ctrl', 'a')
-            time.sleep(0.1)
+            self._input('select', self.backend.hotkey, 'ctrl', 'a')
 
-        # 使用剪贴板输入中文
-        pyperclip.copy(text)
-        pyautogui.hotkey('ctrl', 'v')
+        # 中文经剪贴板粘贴
+        self._input('paste', self.backend.type_text, text)
 
-        if wait := step.get('wait_after'):
-            time.sleep(wait)
+        self._wait_after(step)
         return True
 
     def _action_press_key(self, step):
@@ -203,14 +1843,169 @@ class AutomationBot:
         key = step.get('key', '')
         if '+' in key:
             keys = key.split('+')
-            pyautogui.hotkey(*keys)
+            self._input('hotkey', self.backend.hotkey, *keys)
         else:
-            pyautogui.press(key)
+            self._input('press', self.backend.press, key)
 
-        if wait := step.get('wait_after'):
-            time.sleep(wait)
+        self._wait_after(step)
+        return True
+
+    def _action_probe(self, step, data):
+        """读取目标输入框的当前值，与本行要写入的值相同则跳过保存
+
+        返回 ok / skip / failed
+        """
+        if 'x' in step and 'y' in step:
+            self._input('click', self.backend.click, *self._point(step))
+
+        # 先清空剪贴板，避免读到上一次的内容
+        pyperclip.copy('')
+        self._input('select', self.backend.hotkey, 'ctrl', 'a')
+        self._input('hotkey', self.backend.hotkey, 'ctrl', 'c')
+        self.backend.flush()
+
+        deadline = time.monotonic() + step.get('timeout', 0.5)
+        while (current := pyperclip.paste()) == '' and time.monotonic() < deadline:
+            time.sleep(0.02)
+        current = current.strip()
+        # 校验重试时再次读取到的是刚写入的值，保留第一次读到的原值
+        self.row_info.setdefault('previous', current)
+
+        expected = step['_compare'].render(data)
+        self._wait_after(step)
+
+        if current and compare_values(current, '==', expected):
+            get_logger().info(f"  当前值 {current} 与目标一致，跳过保存")
+            return 'skip'
+        get_logger().info(f"  当前值: {current or '(空)'} -> {expected}")
+        return 'ok'
+
+    def _action_wait_stable(self, step):
+        """等待区域画面稳定，最多等 seconds 秒（默认 5 秒），超时后照常继续"""
+        region = self._region(step)
+        if len(region) != 4:
+            get_logger().error("等待区域格式应为 [x, y, 宽, 高]")
+            return False
+        timeout = step.get('seconds', 5)
+        if not self.capture.wait_stable(region, timeout=timeout, settle=step.get('settle', 2)):
+            get_logger().warning(f"  区域 {region} 在 {timeout} 秒内未稳定，继续执行")
         return True
 
+    def _template_hash(self, name):
+        """读取模板图片并计算哈希（带缓存）"""
+        if name not in self.template_hashes:
+            path = Path(name)
+            if not path.is_absolute():
+                path = self.assets_dir / path
+            # 灰度换算与 ScreenCapture.grab_gray 一致（三通道直接相加），
+            # 不能用 PIL 的 convert('L')：加权亮度在饱和色上会得到不同的哈希
+            with Image.open(path) as img:
+                rgb = np.asarray(img.convert('RGB'), dtype=np.float32)
+            self.template_hashes[name] = region_hash(rgb.sum(axis=2))
+        return self.template_hashes[name]
+
+    def _expected_hashes(self, templates):
+        if isinstance(templates, str):
+            templates = [templates]
+        return [self._template_hash(t) for t in templates]
+
+    def _action_verify(self, step):
+        """屏幕校验 - 截取小区域与模板比对感知哈希"""
+        region = self._region(step)
+        templates = step.get('template')
+        if not region or len(region) != 4 or not templates:
+            get_logger().error("校验步骤未设置区域或模板")
+            return False
+
+        expected = self._expected_hashes(templates)
+        max_distance = step.get('max_distance', 6)
+
+        # 保存后界面可能还在刷新，超时前反复截取
+        matched, distance = self.capture.wait_match(
+            region, expected, max_distance,
+            timeout=step.get('timeout', 1.0),
+            interval=step.get('interval', 0.05)
+        )
+        if not matched:
+            get_logger().warning(f"  校验不匹配: 距离 {distance} > {max_distance}")
+            return False
+
+        self._wait_after(step)
+        return True
+
+    def evaluate_condition(self, cond, data):
+        """计算条件：屏幕区域探测 (region + template) 或行数据比较 (column + op + value)"""
+        if 'not' in cond:
+            return not self.evaluate_condition(cond['not'], data)
+        if 'all' in cond:
+            return all(self.evaluate_condition(c, data) for c in cond['all'])
+        if 'any' in cond:
+            return any(self.evaluate_condition(c, data) for c in cond['any'])
+        if 'region' in cond:
+            matched, _ = self.capture.wait_match(
+                self._region(cond), self._expected_hashes(cond['template']),
+                cond.get('max_distance', 6),
+                timeout=cond.get('timeout', 0),
+                interval=cond.get('interval', 0.05)
+            )
+            return matched
+        if 'column' in cond:
+            right = cond['_template'].render(data)
+            return compare_values(data.get(cond['column']), cond.get('op', '=='), right)
+        raise ValueError(f"无法识别的条件: {cond}")
+
+    def _observe_step(self, name, seconds):
+        self.metrics.observe_step(name, seconds)
+        self.step_durations.setdefault(name, []).append(seconds)
+
+    def run_steps(self, steps, data):
+        """依次执行步骤，返回 (状态, 相关步骤)，状态为 ok / skip / failed"""
+        for step in steps:
+            action = step['action']
+            name = step.get('name', action)
+
+            if action == 'skip_row_if':
+                if self.evaluate_condition(step['when'], data):
+                    get_logger().info(f"  条件满足，跳过本行: {name}")
+                    return 'skip', step
+
+            elif action == 'if':
+                matched = self.evaluate_condition(step['when'], data)
+                get_logger().info(f"  条件 {name}: {'是' if matched else '否'}")
+                status, related = self.run_steps(step.get('then' if matched else 'else', []), data)
+                if status != 'ok':
+                    return status, related
+
+            elif action == 'probe':
+                get_logger().info(f"  执行: {name}")
+                start = time.perf_counter()
+                result = self._action_probe(step, data)
+                self._observe_step(name, time.perf_counter() - start)
+                if result == 'skip':
+                    return 'skip', step
+
+            elif action == 'repeat_until':
+                max_times = step.get('max_times', 10)
+                for attempt in range(max_times + 1):
+                    if self.evaluate_condition(step['when'], data):
+                        break
+                    if attempt == max_times:
+                        get_logger().warning(f"  重复 {max_times} 次后条件仍未满足: {name}")
+                        return 'failed', step
+                    status, related = self.run_steps(step.get('steps', []), data)
+                    if status != 'ok':
+                        return status, related
+                    time.sleep(step.get('interval', 0))
+
+            else:
+                start = time.perf_counter()
+                ok = self.execute_action(step, data)
+                self._observe_step(name, time.perf_counter() - start)
+                if not ok:
+                    return 'failed', step
+
+        return 'ok', None
+
     def process_single_item(self, data, index):
         """处理单条数据"""
         code_col = self.config['excel']['code_column']
@@ -218,62 +2013,573 @@ class AutomationBot:
         code = data[code_col]
         qty = data[qty_col]
 
-        get_logger().info(f"[{index}] 处理: {code} -> {qty}")
+        get_logger().info(f"[{index}] 处理: {code} -> {qty}", extra={'item_code': code})
+
+        if self.anchor:
+            self.anchor.check()
+
+        self.row_info = {}
+        retries = 0
+        while True:
+            status, failed_step = self.run_steps(self.plan, data)
+            if status == 'ok':
+                break
+            # 重试时读取到的当前值已经是目标值，说明上一次其实已经保存成功
+            if status == 'skip' and retries and failed_step['action'] == 'probe':
+                get_logger().info(f"[{index}] 重试时读取到的值已是目标值，上次已保存")
+                break
+            if status == 'skip':
+                self.stats['skipped'] += 1
+                return True
+
+            # 校验失败时可按 retry 次数重新执行整行
+            if failed_step['action'] == 'verify' and retries < failed_step.get('retry', 0):
+                retries += 1
+                get_logger().warning(f"[{index}] 校验失败，第 {retries} 次重试")
+                continue
 
-        for step in self.config['steps']:
-            success = self.execute_action(step, data)
-            if not success:
-                get_logger().error(f"步骤失败: {step.get('name')}")
-                self.stats['failed'] += 1
-                return False
+            get_logger().error(f"步骤失败: {failed_step.get('name')}")
+            self.stats['failed'] += 1
+            return False
 
         self.stats['success'] += 1
         get_logger().info(f"[{index}] 完成")
         return True
 
-    def run(self, limit=0):
-        """主运行方法"""
+    def _emit(self, event, **payload):
+        """向进度通道推送事件，通道满或未设置时直接丢弃，不阻塞主流程"""
+        if self.progress is None:
+            return
+        try:
+            self.progress.put_nowait({'event': event, 'time': time.monotonic(), **self.stats, **payload})
+        except queue.Full:
+            pass
+
+    def prepare_row(self, data):
+        """预先渲染一行要输入的全部文本"""
+        return {id(step): step['_template'].render(data)
+                for step in self.iter_plan() if '_template' in step}
+
+    def _open_backend(self):
+        self.backend = PyAutoGUIBackend()
+        if self.window_title:
+            self.anchor = WindowAnchor(self.window_title).locate()
+
+    def _close_backend(self):
+        self.capture.close()
+        self.backend.close()
+        if self.anchor:
+            self.anchor.close()
+            self.anchor = None
+
+    def _process_row(self, data, index, texts=None):
+        """处理一行，返回 (状态, 附加信息)，状态为 success / failed / skipped / stopped"""
+        self.row_texts = texts or {}
+        before = dict(self.stats)
+        try:
+            self.process_single_item(data, index)
+        except pyautogui.FailSafeException:
+            get_logger().warning("检测到鼠标移至左上角，程序终止")
+            return 'stopped', {}
+        except Exception as e:
+            get_logger().error(f"处理异常: {e}")
+            self.stats['failed'] += 1
+        status = next((k for k in self.stats if self.stats[k] != before[k]), 'failed')
+        return status, dict(self.row_info)
+
+    def _finish_row(self, i, total, data, status, info):
+        """一行结束后的记账：运行流水和进度事件"""
+        excel_cfg = self.config['excel']
+        code = data.get(excel_cfg['code_column'])
+        self.journal.write({'index': i, 'code': code, 'quantity': data.get(excel_cfg['quantity_column']),
+                            'status': status, **info})
+        self._emit('row', done=i, total=total, code=code, status=status)
+        self.metrics.row(status)
+        self.metrics.set_remaining(total - i)
+
+    def _profile_row(self, i, before):
+        """只分析指定行范围时，在范围的首行前开始、末行后停止"""
+        if not isinstance(self.profile, tuple):
+            return
+        start, end = self.profile
+        if before and i == start:
+            get_logger().info(f"开始性能分析: 第 {start}-{end} 行")
+            self.profiler.start()
+        elif not before and i == end and self.profiler.running:
+            self.profiler.stop()
+
+    def _run_rows(self, data_list):
+        """顺序模式：逐行执行，记账穿插在输入事件之间"""
+        self._open_backend()
+        total = len(data_list)
+        columns = set(data_list[0]) if data_list else None
+        try:
+            for i, data in enumerate(data_list, 1):
+                self.reload_config(columns)
+                if not self.within_budget(data_list, i):
+                    break
+                self._profile_row(i, before=True)
+                started = time.monotonic()
+                status, info = self._process_row(data, f"{i}/{total}")
+                self.observe_row_cost(time.monotonic() - started)
+                self._profile_row(i, before=False)
+                if status == 'stopped':
+                    break
+                self._finish_row(i, total, data, status, info)
+        finally:
+            self._close_backend()
+
+    async def _flush_journal_periodically(self, interval=1.0):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.journal.flush)
+
+    async def _run_rows_async(self, data_list):
+        """异步模式：输入线程只负责 UI 操作，记账、写盘、准备下一行都与之重叠
+
+        输入设备（以及截图句柄）只在单独的输入线程里使用；事件循环在输入线程
+        执行当前行时准备下一行的文本、处理上一行的记账，运行流水在后台线程定时写盘。
+        """
+        loop = asyncio.get_running_loop()
+        total = len(data_list)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='input') as input_executor:
+            await loop.run_in_executor(input_executor, self._open_backend)
+            flusher = asyncio.create_task(self._flush_journal_periodically())
+            try:
+                texts = self.prepare_row(data_list[0]) if data_list else None
+                columns = set(data_list[0]) if data_list else None
+                finished = None
+                for i, data in enumerate(data_list, 1):
+                    # 上一行已结束、本行尚未开始，此时换计划不会影响正在执行的行
+                    if self.reload_config(columns):
+                        texts = self.prepare_row(data)
+                    if not self.within_budget(data_list, i):
+                        break
+                    self._profile_row(i, before=True)
+                    started = time.monotonic()
+                    future = loop.run_in_executor(input_executor, self._process_row, data, f"{i}/{total}", texts)
+                    # 当前行执行期间：准备下一行，处理上一行的记账
+                    texts = self.prepare_row(data_list[i]) if i < total else None
+                    if finished:
+                        self._finish_row(*finished)
+                        finished = None
+                    status, info = await future
+                    self.observe_row_cost(time.monotonic() - started)
+                    self._profile_row(i, before=False)
+                    if status == 'stopped':
+                        break
+                    finished = (i, total, data, status, info)
+                if finished:
+                    self._finish_row(*finished)
+            finally:
+                flusher.cancel()
+                await loop.run_in_executor(input_executor, self._close_backend)
+
+    def _run_async(self, data_list):
+        """在事件循环中运行，日志改由后台线程写出"""
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        root.handlers = [logging.handlers.QueueHandler(log_queue)]
+        listener.start()
+        try:
+            asyncio.run(self._run_rows_async(data_list))
+        finally:
+            listener.stop()
+            root.handlers = handlers
+
+    def run(self, limit=0, mode=None, rows=None, countdown=3, profile=None, budget=None):
+        """主运行方法
+
+        mode: sync（默认，顺序执行）或 async（记账与 UI 操作重叠），
+        不指定时取 settings.runner
+        rows: 直接给定已清洗的行数据（任务服务模式），不读取 Excel
+        profile: True 分析整次运行，(起始行, 结束行) 只分析这一段
+        budget: 时间预算（分钟），不指定时取 settings.schedule.budget，0 为不限；
+        预算用完前停下，剩下的行留在 self.leftover
+        """
+        logger = get_logger()
+        mode = mode or (self.config.get('settings') or {}).get('runner', 'sync')
+        if mode not in ('sync', 'async'):
+            raise ValueError(f"未知运行模式: {mode}")
+
+        self.run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        set_run_id(self.run_id)
+        try:
+            self._run(limit, mode, rows, countdown, profile, budget)
+        finally:
+            # 本次运行的编码索引立即可查
+            if handler := archive_handler():
+                handler.index.commit()
+            set_run_id(None)
+
+    def _run(self, limit, mode, rows, countdown, profile, budget):
+        """运行主体，运行编号由 run 设置"""
         logger = get_logger()
         logger.info("=" * 50)
         logger.info("库存自动化程序启动")
+        logger.info(f"运行编号: {self.run_id}")
         logger.info("安全提示: 将鼠标移到屏幕左上角可紧急停止")
         logger.info("=" * 50)
 
         # 倒计时
-        logger.info("3秒后开始，请切换到目标软件窗口...")
-        for i in range(3, 0, -1):
-            logger.info(f"  {i}...")
-            time.sleep(1)
+        if countdown:
+            logger.info(f"{countdown}秒后开始，请切换到目标软件窗口...")
+            for i in range(countdown, 0, -1):
+                logger.info(f"  {i}...")
+                time.sleep(1)
 
-        # 读取数据
-        data_list = self.load_excel()
+        # 读取数据，上次预算用完剩下的行优先
+        pending = self.load_pending() if rows is None else None
+        if rows is None:
+            data_list = pending or self.load_excel()
+        else:
+            data_list = rows
+        data_list = self.prioritize(data_list)
 
-        # 限制执行条数
+        # 限制执行条数；来自待处理队列时超出的行留在队列里
+        self.dropped = []
         if limit > 0:
-            data_list = data_list[:limit]
+            data_list, dropped = data_list[:limit], data_list[limit:]
+            if pending:
+                self.dropped = dropped
 
         # 逐条处理
         total = len(data_list)
-        for i, data in enumerate(data_list, 1):
-            try:
-                self.process_single_item(data, f"{i}/{total}")
-            except pyautogui.FailSafeException:
-                logger.warning("检测到鼠标移至左上角，程序终止")
-                break
-            except Exception as e:
-                logger.error(f"处理异常: {e}")
-                self.stats['failed'] += 1
+        processed_before = sum(self.stats.values())
+        started_at = datetime.now()
+        run_start = time.monotonic()
+        self._emit('start', total=total, run_id=self.run_id)
+        self.metrics.set_remaining(total)
+        self.profile = profile
+        self.profiler = SamplingProfiler()
+        if profile is True:
+            self.profiler.start()
+        exporter = None
+        metrics_options = (self.config.get('settings') or {}).get('metrics')
+        if self.own_metrics and metrics_options:
+            exporter = MetricsExporter(self.metrics, metrics_options).start()
+        self.journal = RunJournal(BASE_DIR / "logs" / f"journal_{self.run_id}.jsonl",
+                                  buffered=(mode == 'async'))
+        self.start_budget(self.schedule.get('budget') if budget is None else budget, total)
+        try:
+            if mode == 'async':
+                self._run_async(data_list)
+            else:
+                self._run_rows(data_list)
+        finally:
+            self.journal.close()
+            self.metrics.set_remaining(0)
+            if exporter:
+                exporter.stop()
+            if self.profiler.running:
+                self.profiler.stop()
+            if self.profiler.stacks:
+                paths = self.profiler.write(profile_output_base())
+                logger.info(f"性能分析结果: {paths[0]} / {paths[1].name}")
+        # 中途停止（如紧急停止）时保留原有的待处理队列；待处理队列里超出 limit 的行留到下次
+        if rows is None and self.leftover:
+            self.save_pending(self.leftover)
+        elif rows is None and sum(self.stats.values()) - processed_before >= total:
+            self.save_pending(self.dropped)
+        self._emit('end', total=total, deferred=len(self.leftover))
 
         # 统计
         logger.info("=" * 50)
         logger.info("运行结束")
         logger.info(f"成功: {self.stats['success']}")
         logger.info(f"失败: {self.stats['failed']}")
+        logger.info(f"跳过: {self.stats['skipped']}")
+        if self.leftover:
+            logger.info(f"未处理: {len(self.leftover)} (时间预算用完)")
+        pacing = self.pacer.report()
+        total_cost = sum(cost for _, cost in pacing.values())
+        logger.info(f"节奏控制 ({self.pacer.profile}) 共等待 {total_cost:.2f} 秒")
+        for kind, (count, cost) in pacing.items():
+            logger.info(f"  {kind}: {count} 次, {cost:.2f} 秒")
         logger.info("=" * 50)
 
+        self.record_history(started_at, time.monotonic() - run_start, mode)
+
+    def record_history(self, started_at, duration, mode):
+        """把本次运行的汇总写入运行历史"""
+        processed = sum(self.stats.values())
+        summary = {
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'config_hash': config_hash(self.config),
+            'mode': mode,
+            'rows': processed,
+            **self.stats,
+            'duration': duration,
+            'rows_per_min': processed / duration * 60 if duration else 0.0,
+            'failure_rate': self.stats['failed'] / processed if processed else 0.0,
+            'step_p95': {name: float(np.percentile(values, 95)) for name, values in self.step_durations.items()},
+        }
+        try:
+            history = RunHistory()
+            history.record(summary)
+            history.close()
+        except sqlite3.Error as e:
+            get_logger().warning(f"保存运行历史失败: {e}")
+            return
+        get_logger().info(f"运行历史已记录: 配置 {summary['config_hash']}, "
+                          f"{summary['rows_per_min']:.1f} 行/分钟, 失败率 {summary['failure_rate']:.1%}")
+
+
+class Job:
+    """提交到任务服务的一批数据，同时充当该批次的进度通道"""
+
+    def __init__(self, rows, budget=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.rows = rows
+        self.budget = budget
+        self.status = 'queued'
+        self.events = []
+        self.cond = threading.Condition()
+
+    def put_nowait(self, event):
+        """与进度队列相同的接口，AutomationBot 直接往这里推送事件"""
+        with self.cond:
+            self.events.append(event)
+            self.cond.notify_all()
+
+    def finish(self, status, **payload):
+        with self.cond:
+            self.status = status
+            self.events.append({'event': status, 'time': time.monotonic(), **payload})
+            self.cond.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+
+    def wait_events(self, start, timeout=15):
+        """返回第 start 条之后的新事件，没有新事件时最多等待 timeout 秒"""
+        with self.cond:
+            if len(self.events) <= start and not self.finished:
+                self.cond.wait(timeout)
+            return self.events[start:], self.finished
+
+    def summary(self):
+        return {'id': self.id, 'status': self.status, 'rows': len(self.rows),
+                'last': self.events[-1] if self.events else None}
+
+
+class JobServer:
+    """本地任务服务 - 通过 HTTP 提交行数据，排队后逐批执行，并流式返回每行进度
+
+    POST /jobs              提交 JSON 或 CSV (Content-Type: text/csv)，返回任务编号；
+                            ?budget=分钟 为该任务设置时间预算，剩余的行重新排队
+    GET  /jobs              任务列表
+    GET  /jobs/<id>         任务状态
+    GET  /jobs/<id>/events  流式进度：默认 JSON Lines，Accept: text/event-stream 时为 SSE
+    GET  /metrics           Prometheus 指标
+    """
+
+    MAX_FINISHED = 100
+
+    def __init__(self, config_path="config.yaml", host='127.0.0.1', port=8765):
+        self.config_path = config_path
+        # 只用于校验提交的数据，不执行任何操作
+        self.parser = AutomationBot(config_path)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.metrics = Metrics()
+        metrics_options = (self.parser.config.get('settings') or {}).get('metrics') or {}
+        self.exporter = MetricsExporter(self.metrics, metrics_options) if metrics_options else None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def submit(self, rows, budget=None):
+        """排队一批数据，返回任务"""
+        job = Job(rows, budget)
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old in finished[:max(0, len(finished) - self.MAX_FINISHED)]:
+                del self.jobs[old.id]
+        job.put_nowait({'event': 'queued', 'time': time.monotonic(), 'position': self.pending.qsize() + 1})
+        self.pending.put(job)
+        self._update_queued()
+        return job
+
+    def _update_queued(self):
+        with self.jobs_lock:
+            self.metrics.set_queued(sum(len(j.rows) for j in self.jobs.values() if j.status == 'queued'))
+
+    def worker(self):
+        """同一时间只有一个任务操作鼠标键盘"""
+        while True:
+            job = self.pending.get()
+            job.status = 'running'
+            self._update_queued()
+            try:
+                bot = AutomationBot(self.config_path, progress=job, metrics=self.metrics)
+                # 配置可能在提交后被修改，按本次加载的配置重新校验列，缺列时任务失败
+                rows = bot.clean_frame(pd.DataFrame(job.rows), keep_extra=True)
+                bot.run(rows=rows, countdown=0, budget=job.budget)
+                if bot.leftover and not sum(bot.stats.values()):
+                    # 预算连一行都不够时不再重新排队，否则会无限循环
+                    job.finish('error', message=f"时间预算不足以完成一行，{len(bot.leftover)} 行未处理",
+                               **bot.stats, deferred=len(bot.leftover))
+                elif bot.leftover:
+                    # 预算用完剩下的行重新排到队尾，先让其它任务执行
+                    retry = self.submit(bot.leftover, job.budget)
+                    get_logger().info(f"任务 {job.id} 剩余 {len(bot.leftover)} 行，重新排队为 {retry.id}")
+                    job.finish('done', **bot.stats, deferred=len(bot.leftover), requeued=retry.id)
+                else:
+                    job.finish('done', **bot.stats)
+            except Exception as e:
+                get_logger().error(f"任务 {job.id} 失败: {e}")
+                job.finish('error', message=str(e))
+
+    def serve_forever(self):
+        threading.Thread(target=self.worker, daemon=True).start()
+        if self.exporter:
+            self.exporter.start()
+        host, port = self.httpd.server_address[:2]
+        get_logger().info(f"任务服务已启动: http://{host}:{port}/jobs")
+        self.httpd.serve_forever()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, fmt, *args):
+                get_logger().debug("HTTP " + fmt % args)
+
+            def _send_json(self, code, payload):
+                body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                path, _, query = self.path.partition('?')
+                if path.rstrip('/') != '/jobs':
+                    return self._send_json(404, {'error': '未知路径'})
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                try:
+                    rows = server.parser.parse_rows(body, self.headers.get('Content-Type', 'application/json'))
+                    budget = parse_qs(query).get('budget')
+                    budget = float(budget[0]) if budget else None
+                    if budget is not None and not (math.isfinite(budget) and budget > 0):
+                        raise ValueError("budget 需要是大于 0 的分钟数")
+                except (ValueError, KeyError, pd.errors.ParserError) as e:
+                    return self._send_json(400, {'error': str(e)})
+                if not rows:
+                    return self._send_json(400, {'error': '没有有效数据'})
+                job = server.submit(rows, budget)
+                get_logger().info(f"收到任务 {job.id}: {len(rows)} 条")
+                self._send_json(202, {'id': job.id, 'rows': len(rows), 'events': f"/jobs/{job.id}/events"})
+
+            def do_GET(self):
+                parts = [p for p in self.path.split('?')[0].split('/') if p]
+                if parts == ['metrics']:
+                    body = server.metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if parts == ['jobs']:
+                    with server.jobs_lock:
+                        jobs = list(server.jobs.values())
+                    return self._send_json(200, [j.summary() for j in jobs])
+                job = server.jobs.get(parts[1]) if len(parts) >= 2 and parts[0] == 'jobs' else None
+                if job is None:
+                    return self._send_json(404, {'error': '任务不存在'})
+                if len(parts) == 2:
+                    return self._send_json(200, job.summary())
+                if parts[2:] == ['events']:
+                    return self._stream(job)
+                self._send_json(404, {'error': '未知路径'})
+
+            def _stream(self, job):
+                sse = 'text/event-stream' in self.headers.get('Accept', '')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream' if sse else 'application/x-ndjson')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                sent = 0
+                try:
+                    while True:
+                        events, finished = job.wait_events(sent)
+                        sent += len(events)
+                        for event in events:
+                            line = json.dumps(event, ensure_ascii=False, default=str)
+                            self._write_chunk((f"data: {line}\n\n" if sse else line + '\n').encode('utf-8'))
+                        if not events and sse:
+                            self._write_chunk(b": keep-alive\n\n")
+                        if finished and sent >= len(job.events):
+                            break
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
 
 def main():
     """程序入口"""
+    parser = argparse.ArgumentParser(description="库存批量修改自动化工具")
+    parser.add_argument('--serve', action='store_true', help="任务服务模式：通过本地 HTTP 接口提交数据")
+    parser.add_argument('--host', default='127.0.0.1', help="任务服务监听地址")
+    parser.add_argument('--port', type=int, default=8765, help="任务服务端口")
+    parser.add_argument('--budget', type=parse_budget, metavar='分钟',
+                        help="时间预算：在此时间内按优先级处理，剩余的行留到下次运行 (0 为不限)")
+    parser.add_argument('--profile', action='store_true', help="采样分析整次运行，结果写到 logs/")
+    parser.add_argument('--profile-rows', metavar='起-止', help="只分析这一段行，如 500-550")
+    parser.add_argument('--compare', nargs='*', metavar='编号',
+                        help="对比运行历史的吞吐：不带参数对比最近两组，也可指定两个配置指纹/机器名")
+    parser.add_argument('--by', choices=['config', 'host'], default='config', help="--compare 的分组方式")
+    parser.add_argument('--lookup', metavar='编码', help="从日志索引查找该编码最近的处理记录")
+    parser.add_argument('--count', type=int, default=1, help="--lookup 显示最近几次")
+    args = parser.parse_args()
+
+    if args.lookup is not None:
+        index = LogIndex()
+        entries = index.lookup(args.lookup, args.count)
+        index.close()
+        if not entries:
+            print(f"日志索引中没有编码 {args.lookup}")
+        for run_id, created, file, offset in entries:
+            print(f"\n运行 {run_id}  {datetime.fromtimestamp(created):%Y-%m-%d %H:%M:%S}  {file}")
+            print('\n'.join(read_log_entry(file, offset)))
+        return
+
+    if args.compare is not None:
+        if len(args.compare) not in (0, 2):
+            parser.error("--compare 需要 0 个或 2 个参数")
+        history = RunHistory()
+        by = 'config_hash' if args.by == 'config' else 'host'
+        print('\n'.join(history.compare(*args.compare, by=by)))
+        history.close()
+        return
+    profile = parse_row_range(args.profile_rows) if args.profile_rows else (True if args.profile else None)
+
+    if args.serve:
+        try:
+            JobServer(host=args.host, port=args.port).serve_forever()
+        except KeyboardInterrupt:
+            print("\n任务服务已停止")
+        return
+
     print("\n" + "=" * 50)
     print("  库存批量修改自动化工具")
     print("=" * 50)
@@ -286,7 +2592,7 @@ def main():
     try:
         input()
         bot = AutomationBot()
-        bot.run()
+        bot.run(profile=profile, budget=args.budget)
     except KeyboardInterrupt:
         print("\n用户取消")
     except Exception as e: